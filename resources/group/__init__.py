@@ -0,0 +1,2 @@
+import models
+import endpoints
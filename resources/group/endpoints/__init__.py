@@ -0,0 +1,2 @@
+import groups
+import messages
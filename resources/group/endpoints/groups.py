@@ -0,0 +1,72 @@
+import server
+import resources.user
+import resources.group.models
+
+
+class Endpoint(server.Endpoint):
+
+    url = '/groups'
+
+    post_body_parser = server.BodyParser()
+    post_body_parser.add_argument('name', help='name of the group', required=True)
+    post_body_parser.add_argument('members', help='list of usernames to add to the group', type=list, required=True)
+
+    @server.read_only
+    @resources.user.authenticate
+    def get(self):
+        Group = resources.group.models.Group
+        GroupMember = resources.group.models.GroupMember
+
+        # fetch the groups of the user, along with all of their members
+        user_groups = self.session.query(GroupMember.group_id).filter(GroupMember.username == self.auth.username)
+        rows = self.session.query(Group, GroupMember.username) \
+                           .join(GroupMember, GroupMember.group_id == Group.id) \
+                           .filter(Group.id.in_(user_groups)) \
+                           .order_by(Group.id, GroupMember.id) \
+                           .all()
+
+        groups = []
+        for group, username in rows:
+            if not groups or groups[-1][0] is not group:
+                groups.append((group, []))
+            groups[-1][1].append(username)
+
+        return {'groups': [group.render(members=members) for group, members in groups]}
+
+    @resources.user.authenticate
+    def post(self):
+        # parse request
+        body = Endpoint.post_body_parser.parse_args()
+
+        if not all(isinstance(username, basestring) for username in body.members):
+            raise server.RestfulException(400, 'invalid field "members": expected a list of usernames')
+
+        # the owner is always a member of the group
+        members = set(body.members) | {self.auth.username}
+
+        if len(members) > resources.group.models.Group.max_members:
+            raise server.RestfulException(400, 'a group cannot have more than {0} members'
+                                               .format(resources.group.models.Group.max_members))
+
+        # make sure that all members exist, using a single query
+        existing = set(username for username, in self.session.query(resources.user.models.User.username)
+                       .filter(resources.user.models.User.username.in_(members)))
+
+        if existing != members:
+            raise server.RestfulException(404, 'users not found: {0}'.format(', '.join(sorted(members - existing))))
+
+        # create group and its members
+        try:
+            group = resources.group.models.Group(body.name, self.auth.username)
+            self.session.add(group)
+            self.session.flush()
+
+            self.session.bulk_save_objects([resources.group.models.GroupMember(group.id, username)
+                                            for username in sorted(members)])
+            self.session.commit()
+
+        except AssertionError:
+            raise server.RestfulException(400, resources.group.models.Group.assert_fail_reasons)
+
+        # return success
+        return group.render(members=sorted(members)), 201
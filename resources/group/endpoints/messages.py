@@ -0,0 +1,62 @@
+import time
+
+import server
+import resources.user
+import resources.group.models
+import resources.message.models
+
+
+class Endpoint(server.Endpoint):
+
+    url = '/groups/messages'
+
+    post_body_parser = server.BodyParser()
+    post_body_parser.add_argument('group', help='id of the group', type=int, required=True)
+    post_body_parser.add_argument('contents', help='contents of the message', required=True)
+
+    @resources.user.authenticate
+    def post(self):
+        # parse request
+        body = Endpoint.post_body_parser.parse_args()
+
+        # get the members of the group
+        members = [username for username, in self.session.query(resources.group.models.GroupMember.username)
+                   .filter(resources.group.models.GroupMember.group_id == body.group)]
+
+        # only members may send messages to a group. nonexistent groups are indistinguishable from foreign ones
+        if self.auth.username not in members:
+            raise server.RestfulException(404, 'group not found')
+
+        recipients = [username for username in members if username != self.auth.username]
+
+        # store the contents once per shard, and a lightweight message per recipient that points at them
+        shards = {}
+        for recipient in recipients:
+            shards.setdefault(self.shard(recipient), []).append(recipient)
+
+        # all shards are written before any of them is committed, so that most failures leave nothing committed
+        sent_at = int(time.time())
+        for shard, shard_recipients in shards.iteritems():
+            payload = resources.message.models.Payload(self.auth.username, body.group, body.contents)
+            shard.add(payload)
+            shard.flush()
+
+            shard.bulk_save_objects([resources.message.models.Message(self.auth.username, recipient, None,
+                                                                      payload=payload)
+                                     for recipient in shard_recipients])
+            sent_at = payload.sent_at
+
+        # recipients on shards that failed to commit are reported, while the others have received the message
+        undelivered = [recipient for shard in self.commit_shards(shards.keys()) for recipient in shards[shard]]
+        delivered = [recipient for recipient in recipients if recipient not in undelivered]
+
+        # wake up the recipients' long polling requests
+        self.after_commit(lambda: [self.notifier.notify(recipient) for recipient in delivered])
+
+        # return success
+        return {'group_id': body.group,
+                'from_user': self.auth.username,
+                'contents': body.contents,
+                'sent_at': sent_at,
+                'recipients': len(delivered),
+                'undelivered': undelivered}, 201
@@ -0,0 +1,47 @@
+import re
+
+import server
+from resources.user.models import User
+
+
+class Group(server.Model):
+
+    name = server.ModelField(server.ModelTypes.String(64))
+    owner = server.ModelField(User.UsernameType)
+
+    renders_fields = ['name', 'owner']
+    assert_fail_reasons = 'bad group name, should not be empty and not longer than 64 characters'
+
+    allowed_names = re.compile('^.{1,64}$')
+
+    # maximal number of members in a group, including its owner
+    max_members = 256
+
+    def __init__(self, name, owner):
+        assert Group.allowed_names.match(name)
+
+        self.name = name
+        self.owner = owner
+
+    def render(self, members=None, **kwargs):
+        '''
+        :param members: list of the usernames of the group's members (optional)
+        '''
+        group = super(Group, self).render(**kwargs)
+
+        if members is not None:
+            group['members'] = members
+
+        return group
+
+
+class GroupMember(server.Model):
+
+    group_id = server.ModelField(server.ModelTypes.Integer, server.ModelTypes.ForeignKey('groups.id'))
+    username = server.ModelField(User.UsernameType)
+
+    indexes = [('group_id', 'username'), ('username',)]
+
+    def __init__(self, group_id, username):
+        self.group_id = group_id
+        self.username = username
@@ -1,2 +1,4 @@
 import models
 import endpoints
+import migrations
+import retention
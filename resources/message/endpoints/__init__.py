@@ -1 +1,3 @@
 import messages
+import batch
+import ack
@@ -0,0 +1,52 @@
+import sqlalchemy
+
+import server
+import resources.user
+import resources.message.models
+
+
+class Endpoint(server.Endpoint):
+
+    url = '/messages/ack'
+
+    # maximal number of ids and ranges that can be acknowledged in a single request
+    max_ids = 1000
+    max_ranges = 100
+
+    post_body_parser = server.BodyParser()
+    post_body_parser.add_argument('ids', help='list of ids of delivered messages', type=list, default=[])
+    post_body_parser.add_argument('ranges', help='list of [first, last] inclusive ranges of ids of delivered messages',
+                                  type=list, default=[])
+
+    @resources.user.authenticate
+    def post(self):
+        # parse request
+        body = Endpoint.post_body_parser.parse_args()
+
+        if not body.ids and not body.ranges:
+            raise server.RestfulException(400, 'the request did not contain any "ids" or "ranges" to acknowledge')
+
+        if len(body.ids) > Endpoint.max_ids or not all(self._is_id(message_id) for message_id in body.ids):
+            raise server.RestfulException(400, 'invalid field "ids": expected a list of up to {0} message ids'
+                                               .format(Endpoint.max_ids))
+
+        if len(body.ranges) > Endpoint.max_ranges or \
+                not all(isinstance(id_range, list) and len(id_range) == 2 and all(map(self._is_id, id_range))
+                        for id_range in body.ranges):
+            raise server.RestfulException(400, 'invalid field "ranges": expected a list of up to {0} [first, last] '
+                                               'pairs of message ids'.format(Endpoint.max_ranges))
+
+        # delete all acknowledged messages of the user in a single statement
+        Message = resources.message.models.Message
+        acknowledged = [Message.id.between(first, last) for first, last in body.ranges]
+        if body.ids:
+            acknowledged.append(Message.id.in_(body.ids))
+
+        deleted_count = Message.delete_where(self.shard(self.auth.username),
+                                             Message.to_user == self.auth.username, sqlalchemy.or_(*acknowledged))
+
+        return {'result': 'success', 'deleted': deleted_count}
+
+    @staticmethod
+    def _is_id(value):
+        return isinstance(value, (int, long)) and not isinstance(value, bool)
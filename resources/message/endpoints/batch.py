@@ -0,0 +1,85 @@
+import server
+import resources.user
+import resources.message.models
+
+
+class Endpoint(server.Endpoint):
+
+    url = '/messages/batch'
+
+    # maximal number of messages that can be sent in a single request
+    max_batch_size = 100
+
+    post_body_parser = server.BodyParser()
+    post_body_parser.add_argument('messages', help='list of messages, each with a recipient and contents', type=list,
+                                  required=True)
+
+    @resources.user.authenticate
+    def post(self):
+        # parse request
+        body = Endpoint.post_body_parser.parse_args()
+
+        if not 0 < len(body.messages) <= Endpoint.max_batch_size:
+            raise server.RestfulException(400, 'invalid field "messages": expected between 1 and {0} messages'
+                                               .format(Endpoint.max_batch_size))
+
+        # validate the items, and create a message for each of the valid ones
+        results = []
+        messages = {}
+
+        for index, item in enumerate(body.messages):
+            recipient = item.get('recipient') if isinstance(item, dict) else None
+            contents = item.get('contents') if isinstance(item, dict) else None
+            results.append({'recipient': recipient, 'status': 201})
+
+            if not isinstance(recipient, basestring) or not isinstance(contents, basestring):
+                results[index].update(status=400, message='expected an object with "recipient" and "contents"')
+                continue
+
+            try:
+                messages[index] = resources.message.models.Message(self.auth.username, recipient, contents)
+            except AssertionError:
+                results[index].update(status=400, message=resources.message.models.Message.assert_fail_reasons)
+
+        # make sure that all recipients exist, using a single query
+        recipients = set(message.to_user for message in messages.itervalues())
+        existing = set()
+
+        if recipients:
+            existing = set(username for username, in self.session.query(resources.user.models.User.username)
+                           .filter(resources.user.models.User.username.in_(recipients)))
+
+        for index, message in messages.items():
+            if message.to_user not in existing:
+                results[index].update(status=404, message='user not found')
+                del messages[index]
+
+        # insert the messages of each shard at once, loading their ids. all shards are written before any of them is
+        # committed, so that invalid messages fail the request while nothing has been committed
+        shards = {}
+        for index, message in messages.iteritems():
+            shards.setdefault(self.shard(message.to_user), {})[index] = message
+
+        try:
+            for shard, shard_messages in shards.iteritems():
+                shard.bulk_save_objects(shard_messages.values(), return_defaults=True)
+
+        except server.IntegrityError:
+            raise server.RestfulException(400, resources.message.models.Message.integrity_fail_reasons)
+
+        # messages of shards that failed to commit are reported, while the others have been sent
+        for shard in self.commit_shards(shards.keys()):
+            for index in shards[shard]:
+                results[index].update(status=500, message='message could not be stored')
+                del messages[index]
+
+        # sent messages are reported along with their ids, so that clients can tell them apart (e.g. to acknowledge)
+        for index, message in messages.iteritems():
+            results[index]['id'] = message.id
+
+        # wake up the recipients' long polling requests
+        recipients = set(message.to_user for message in messages.itervalues())
+        self.after_commit(lambda: [self.notifier.notify(recipient) for recipient in recipients])
+
+        # return the outcome of each message, in the order they were sent
+        return {'sent': len(messages), 'failed': len(results) - len(messages), 'results': results}
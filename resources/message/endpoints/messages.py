@@ -1,4 +1,5 @@
 import time
+import sqlalchemy
 
 import server
 import resources.user
@@ -9,43 +10,128 @@ class Endpoint(server.Endpoint):
 
     url = '/messages'
 
+    # page size of message queries, unless requested otherwise
+    default_page_size = 100
+    max_page_size = 1000
+
+    # maximal number of seconds a long polling request may wait for new messages
+    max_wait = 30
+
+    get_querystring_parser = server.QuerystringParser()
+    get_querystring_parser.add_argument('after_id', help='id of the last received message, for incremental sync')
+    get_querystring_parser.add_argument('limit', help='maximal number of messages to return')
+    get_querystring_parser.add_argument('wait', help='seconds to wait for new messages, if there are none')
+
+    post_body_parser = server.BodyParser()
+    post_body_parser.add_argument('recipient', help='username of the recipient', required=True)
+    post_body_parser.add_argument('contents', help='contents of the message', required=True)
+
+    delete_querystring_parser = server.QuerystringParser()
+    delete_querystring_parser.add_argument('until', help='timestamp of the last query time', required=True)
+
+    @server.read_only
     @resources.user.authenticate
     def get(self):
-        # remember the time where the query has started
-        query_time = time.time()
+        querystring = Endpoint.get_querystring_parser.parse_args()
 
-        # fetch all messages
-        messages = self.session.query(resources.message.models.Message) \
-                    .filter(resources.message.models.Message.to_user == self.auth.user.username) \
-                    .order_by(resources.message.models.Message.sent_at.desc()) \
-                    .limit(100) \
-                    .all()
+        try:
+            after_id = int(querystring.after_id) if querystring.after_id is not None else None
+        except:
+            raise server.RestfulException(400, 'invalid field "after_id": valid message id expected')
 
-        # return relevant messages and query time
-        return {'query_time': int(query_time),
-                'messages': [message.render() for message in messages]}
+        try:
+            limit = int(querystring.limit) if querystring.limit is not None else Endpoint.default_page_size
+            assert 0 < limit <= Endpoint.max_page_size
+        except:
+            raise server.RestfulException(400, 'invalid field "limit": expected a number between 1 and {0}'
+                                               .format(Endpoint.max_page_size))
+
+        try:
+            wait = float(querystring.wait) if querystring.wait is not None else 0
+            assert 0 <= wait <= Endpoint.max_wait
+        except:
+            raise server.RestfulException(400, 'invalid field "wait": expected a number of seconds up to {0}'
+                                               .format(Endpoint.max_wait))
+
+        # read the notification state before querying, so that messages sent during the query are not missed
+        notification_version = self.notifier.version(self.auth.username)
+
+        # remember the time where the query has started
+        query_time = time.time()
+        messages, has_more = self._fetch_messages(after_id, limit)
+
+        # long poll: wait for new messages without holding a db connection, and query again once notified. the new
+        # messages are read from the primary db, since replicas may not have caught up with them yet
+        if not messages and wait > 0:
+            self.release_session()
+
+            if self.notifier.wait(self.auth.username, notification_version, wait):
+                self.use_primary()
+                query_time = time.time()
+                messages, has_more = self._fetch_messages(after_id, limit)
+
+        envelope = {'query_time': int(query_time), 'has_more': has_more}
+
+        # the cursor points at the newest message the client has received. the newest messages have no cursor, since
+        # continuing from the newest of them would skip the older messages that were not returned
+        if after_id is not None:
+            envelope['next_cursor'] = max([message.id for message in messages] + [after_id])
+
+        # return relevant messages, query time and cursor. messages are rendered while the response is being sent
+        return server.Stream((resources.message.models.Message.render_record(message) for message in messages),
+                             envelope=envelope, key='messages')
+
+    def _fetch_messages(self, after_id, limit):
+        '''
+        Fetches a page of the user's messages.
+
+        Without a cursor, the newest messages are fetched, newest first, and there are more messages to fetch if older
+        ones were left out. That mode does not paginate, so clients that sync their full history should start from
+        `after_id` 0.
+
+        :param after_id: id of the last received message, or None to fetch the newest messages
+        :param limit: page size
+        :return: a tuple of the messages (as records) and whether there are more messages to fetch
+        '''
+        Message = resources.message.models.Message
+        Payload = resources.message.models.Payload
+
+        # messages are only rendered, so they are read as plain records rather than orm objects.
+        # messages that are sent to groups are joined with their shared payloads.
+        statement = sqlalchemy.select(Message.columns('id', 'from_user', 'to_user', 'sent_at') +
+                                      [sqlalchemy.func.coalesce(Message.contents, Payload.contents).label('contents'),
+                                       Payload.group_id]) \
+                              .select_from(Message.__table__.outerjoin(Payload.__table__,
+                                                                       Message.payload_id == Payload.id)) \
+                              .where(Message.to_user == self.auth.username)
+
+        if after_id is None:
+            # fetch the newest messages
+            statement = statement.order_by(Message.sent_at.desc(), Message.id.desc())
+        else:
+            # fetch messages after the cursor, oldest first
+            statement = statement.where(Message.id > after_id).order_by(Message.id.asc())
+
+        # an extra message is fetched to tell whether there are more
+        messages = server.select_records(self.shard(self.auth.username), statement.limit(limit + 1))
+        return messages[:limit], len(messages) > limit
 
     @resources.user.authenticate
     def post(self):
         # parse request
-        body_parser = server.BodyParser()
-        body_parser.add_argument('recipient', help='username of the recipient', required=True)
-        body_parser.add_argument('contents', help='contents of the message', required=True)
-        body = body_parser.parse_args()
+        body = Endpoint.post_body_parser.parse_args()
 
-        # get user by username
-        try:
-            user = self.session.query(resources.user.models.User) \
-                .filter(resources.user.models.User.username == body.recipient) \
-                .limit(1).all()[0]
-        except Exception:
+        # make sure that the recipient exists, through the directory of users
+        entry = resources.user.user_directory.lookup(lambda: self.session, body.recipient)
+        if entry is None:
             raise server.RestfulException(404, 'user not found')
 
-        # create message
+        recipient = entry.username
+
+        # create message on the shard of the recipient
         try:
-            message = resources.message.models.Message(self.auth.user.username, user.username, body.contents)
-            self.session.add(message)
-            self.session.commit()
+            message = resources.message.models.Message(self.auth.username, recipient, body.contents)
+            rendered_message = self.write(message, shard_key=recipient).render()
 
         except server.IntegrityError:
             raise server.RestfulException(400, resources.message.models.Message.integrity_fail_reasons)
@@ -53,23 +139,23 @@ class Endpoint(server.Endpoint):
         except AssertionError:
             raise server.RestfulException(400, resources.message.models.Message.assert_fail_reasons)
 
+        # wake up the recipient's long polling requests
+        self.after_commit(lambda: self.notifier.notify(recipient))
+
         # return success
-        return message.render(), 201
+        return rendered_message, 201
 
     @resources.user.authenticate
     def delete(self):
-        querystring_parser = server.QuerystringParser()
-        querystring_parser.add_argument('until', help='timestamp of the last query time', required=True)
-        querystring = querystring_parser.parse_args()
+        querystring = Endpoint.delete_querystring_parser.parse_args()
 
         try:
             query_timestamp = int(querystring.until)
         except:
             raise server.RestfulException(400, 'invalid field "until": valid unix timestamp expected')
 
-        deleted_count = self.session.query(resources.message.models.Message) \
-                                    .filter(resources.message.models.Message.to_user == self.auth.user.username,
-                                            resources.message.models.Message.sent_at < query_timestamp) \
-                                    .delete()
+        Message = resources.message.models.Message
+        deleted_count = Message.delete_where(self.shard(self.auth.username),
+                                             Message.to_user == self.auth.username, Message.sent_at < query_timestamp)
 
         return {'result': 'success', 'deleted': deleted_count}
@@ -0,0 +1,16 @@
+import server
+import server.migrations
+from resources.message.models import Message
+
+
+migrations = [
+    server.Migration(1, 'index messages by recipient',
+                     lambda connection: server.migrations.ensure_indexes(connection, Message,
+                                                                         'ix_messages_to_user_sent_at',
+                                                                         'ix_messages_to_user_id')),
+    server.Migration(2, 'add shared payloads to messages',
+                     lambda connection: server.migrations.ensure_columns(connection, Message, 'payload_id')),
+    server.Migration(3, 'index messages by payload, for removing orphan payloads',
+                     lambda connection: server.migrations.ensure_indexes(connection, Message,
+                                                                         'ix_messages_payload_id')),
+]
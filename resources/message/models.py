@@ -1,24 +1,94 @@
 import time
 
+import sqlalchemy
+
 import server
 from resources.user.models import User
 
 
+class Payload(server.Model):
+    '''
+    Contents shared by multiple messages (e.g. a message sent to a group), stored once regardless of the number of
+    recipients.
+    '''
+
+    from_user = server.ModelField(User.UsernameType)
+    group_id = server.ModelField(server.ModelTypes.Integer)
+    contents = server.ModelField(server.ModelTypes.String(4096))
+    sent_at = server.ModelField(server.ModelTypes.Integer)
+
+    # payloads are stored on the shards of the messages that point at them
+    sharded = True
+
+    def __init__(self, from_user, group_id, contents):
+        self.from_user = from_user
+        self.group_id = group_id
+        self.contents = contents
+        self.sent_at = int(time.time())
+
+
 class Message(server.Model):
+    '''
+    A message to a single recipient. Messages either hold their own contents, or point at a shared payload.
+
+    Messages are sharded by their recipient, see `Endpoint.shard`.
+    '''
 
     from_user = server.ModelField(User.UsernameType)
     to_user = server.ModelField(User.UsernameType)
     contents = server.ModelField(server.ModelTypes.String(4096))
     sent_at = server.ModelField(server.ModelTypes.Integer)
+    payload_id = server.ModelField(server.ModelTypes.Integer, nullable=True)
 
     renders_fields = ['from_user', 'to_user', 'contents', 'sent_at']
+    indexes = [('to_user', 'sent_at'), ('to_user', 'id'), ('payload_id',)]
+    sharded = True
     integrity_fail_reasons = 'message is either sent by or sent to nonexistent users'
     assert_fail_reasons = 'cannot send a message '
 
-    def __init__(self, from_user, to_user, contents):
+    def __init__(self, from_user, to_user, contents, payload=None):
         self.from_user = from_user
         self.to_user = to_user
-        self.contents = contents
+        self.contents = contents if payload is None else None
         self.sent_at = int(time.time())
+        self.payload_id = payload.id if payload is not None else None
 
         assert from_user != to_user
+
+    @classmethod
+    def delete_where(cls, session, *criteria):
+        '''
+        Deletes messages, along with the shared payloads that are no longer pointed at by any message.
+
+        :param session: session of the shard of the messages
+        :param criteria: criteria of the messages to delete
+        :return: number of deleted messages
+        '''
+        payload_ids = [payload_id for payload_id, in session.query(cls.payload_id)
+                                                            .filter(cls.payload_id.isnot(None), *criteria)
+                                                            .distinct()]
+
+        deleted_count = session.query(cls).filter(*criteria).delete(synchronize_session=False)
+
+        if payload_ids:
+            referenced = sqlalchemy.exists().where(cls.payload_id == Payload.id)
+            session.query(Payload) \
+                   .filter(Payload.id.in_(payload_ids), ~referenced) \
+                   .delete(synchronize_session=False)
+
+        return deleted_count
+
+    @classmethod
+    def render_record(cls, record):
+        '''
+        Renders a message that was read as a record, along with the group it was sent to (if any).
+
+        :param record: a record with the rendered fields of the message, where contents are taken from the payload of
+                       messages that have one, and the `group_id` of the payload
+        '''
+        message = cls.renderer()(record)
+
+        if record.group_id is not None:
+            message['group_id'] = record.group_id
+
+        return message
@@ -0,0 +1,89 @@
+import time
+
+import sqlalchemy
+
+from resources.message.models import Message, Payload
+
+
+class Retention(object):
+    '''
+    Removes messages that were never deleted by their recipients (e.g. of abandoned accounts), so that the messages
+    table does not grow without bound.
+
+    Messages are removed in small batches, each in its own transaction, so that senders are never blocked for long.
+    '''
+
+    def __init__(self, max_age=None, max_queue=None, batch_size=500):
+        '''
+        :param max_age: seconds after which messages are expired (optional)
+        :param max_queue: maximal number of messages kept per recipient, where older ones are removed first (optional)
+        :param batch_size: maximal number of messages removed per transaction
+        '''
+        self.max_age = max_age
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+
+    def run(self, session):
+        '''
+        Applies the policy to the messages of a db (or shard).
+
+        :param session: session of the db
+        :return: a dict with the number of expired and trimmed messages, and of removed orphan payloads
+        '''
+        counts = {'expired': 0, 'trimmed': 0, 'orphan_payloads': 0}
+
+        if self.max_age is not None:
+            cutoff = int(time.time()) - self.max_age
+            counts['expired'] = self._delete_batches(session, Message, Message.sent_at < cutoff)
+
+        if self.max_queue is not None:
+            counts['trimmed'] = self._trim_queues(session)
+
+        # payloads of group messages are no longer needed once all of their messages have been removed, either here
+        # or by their recipients
+        referenced = sqlalchemy.exists().where(Message.payload_id == Payload.id)
+        counts['orphan_payloads'] = self._delete_batches(session, Payload, ~referenced)
+
+        return counts
+
+    def _trim_queues(self, session):
+        trimmed = 0
+
+        overflowing = session.query(Message.to_user) \
+                             .group_by(Message.to_user) \
+                             .having(sqlalchemy.func.count(Message.id) > self.max_queue) \
+                             .all()
+
+        for recipient, in overflowing:
+            # the id of the newest message of the recipient that is beyond the cap
+            last_trimmed_id = session.query(Message.id) \
+                                     .filter(Message.to_user == recipient) \
+                                     .order_by(Message.id.desc()) \
+                                     .offset(self.max_queue) \
+                                     .limit(1) \
+                                     .scalar()
+
+            if last_trimmed_id is not None:
+                trimmed += self._delete_batches(session, Message,
+                                                Message.to_user == recipient, Message.id <= last_trimmed_id)
+
+        return trimmed
+
+    def _delete_batches(self, session, model, *criteria):
+        '''
+        Deletes the rows that match the criteria, oldest first, in batches.
+
+        :return: number of deleted rows
+        '''
+        deleted = 0
+
+        while True:
+            ids = [row_id for row_id, in session.query(model.id)
+                                               .filter(*criteria)
+                                               .order_by(model.id)
+                                               .limit(self.batch_size)]
+            if not ids:
+                return deleted
+
+            deleted += session.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+            session.commit()
@@ -1,4 +1,7 @@
 import models
 import endpoints
+import migrations
+import metrics
 
 from authentication import authenticate
+from directory import user_directory
@@ -1,36 +1,84 @@
+import hashlib
+import functools
+
 import server
 import resources.user.models
-import collections
+import resources.user.tokens
+
+
+# caches successful authentications per process, so that hot users (e.g. clients polling for messages) skip both the
+# user query and the salted rehash of their token. entries are keyed by username and are only valid for the exact
+# token (digest) that was verified against the db.
+auth_cache = server.LRUCache(max_size=4096, ttl=300)
+
+# credentials are passed in the request headers
+headers_parser = server.HeadersParser()
+headers_parser.add_argument('authorization', help='bearer session token, as issued by login')
+headers_parser.add_argument('x-user-name', help='name of the user to authenticate')
+headers_parser.add_argument('x-user-token', help='authentication token as set in registration')
 
 
 def authenticate(func):
     '''
     The authentication decorator is meant for resources which would like to authenticate an incoming request.
-    
-    If successful, a `user` object will be attached to the instance.
-     
+
+    Requests are authenticated either by a bearer session token (see the `login` endpoint), or by the username and
+    password headers.
+
+    If successful, an `auth` object will be attached to the instance. The user's row is only loaded from the db if
+    the endpoint accesses `self.auth.user`.
+
     :param func: endpoint handler
     '''
 
+    @functools.wraps(func)
     def wrapped(self, *args, **kwargs):
         try:
             # parse headers
-            header_parser = server.HeadersParser()
-            header_parser.add_argument('x-user-name', help='name of the user to authenticate', required=True)
-            header_parser.add_argument('x-user-token', help='authentication token as set in registration',
-                                       required=True)
-            headers = header_parser.parse_args()
-
-            # try to get user
-            user = self.session.query(resources.user.models.User) \
-                               .filter(resources.user.models.User.username == headers.x_user_name) \
-                               .limit(1).all()[0]
-
-            # check password
-            if user.check_password(headers.x_user_token):
-                self.auth = Auth(user=user)
+            headers = headers_parser.parse_args()
+
+            if headers.authorization is not None:
+                # session tokens are verified by signature alone, without accessing the db
+                scheme, token = headers.authorization.split(' ', 1)
+                identity = resources.user.tokens.verify(token) if scheme.lower() == 'bearer' else None
+
+                if identity is None:
+                    raise Exception('invalid token')
+
+                self.consistency_key = identity[0]
+
+                self.auth = Auth(username=identity[0], user_id=identity[1], endpoint=self, by_token=True)
+
+            elif headers.x_user_name is None or headers.x_user_token is None:
+                raise Exception('missing credentials')
+
             else:
-                raise Exception('wrong password')
+                # the user is identified before accessing the db, so that they are served by the primary db if they
+                # have just written to it
+                self.consistency_key = headers.x_user_name
+
+                # try cache first
+                token_digest = _digest(headers.x_user_token)
+                cached = auth_cache.get(headers.x_user_name)
+
+                if cached is not None and cached[0] == token_digest:
+                    self.auth = Auth(username=headers.x_user_name, user_id=cached[1], endpoint=self)
+
+                else:
+                    # try to get user
+                    user = _find_user(self.session, headers.x_user_name)
+
+                    # a lagging replica may not have users who have just registered or changed their password yet
+                    if (user is None or not user.check_password(headers.x_user_token)) and self.reads_replica:
+                        self.use_primary()
+                        user = _find_user(self.session, headers.x_user_name)
+
+                    # check password
+                    if user.check_password(headers.x_user_token):
+                        self.auth = Auth(username=user.username, user_id=user.id, user=user)
+                        auth_cache.set(user.username, (token_digest, user.id))
+                    else:
+                        raise Exception('wrong password')
 
         except:
             # if failed for any reason, raise unauthorized
@@ -41,14 +89,94 @@ def authenticate(func):
     return wrapped
 
 
+def identify(request):
+    '''
+    Identifies the user of a request without accessing the db, e.g. in order to limit the rate of their requests before
+    handling them (see `Server.use_rate_limits`).
+
+    Session tokens are verified by their signature. Usernames and passwords are only trusted if they have already been
+    verified and cached by this process.
+
+    :param request: the request
+    :return: name of the user, or None if they cannot be verified without the db
+    '''
+    authorization = request.headers.get('authorization')
+
+    if authorization is not None:
+        scheme, _, token = authorization.partition(' ')
+        identity = resources.user.tokens.verify(token) if scheme.lower() == 'bearer' else None
+        return identity[0] if identity is not None else None
+
+    username = request.headers.get('x-user-name')
+    token = request.headers.get('x-user-token')
+
+    if username is None or token is None:
+        return None
+
+    cached = auth_cache.peek(username)
+    return username if cached is not None and cached[0] == _digest(token) else None
+
+
+def _find_user(session, username):
+    '''
+    :param session: session to query with
+    :param username: name of the user
+    :return: the user, or None if there is no such user
+    '''
+    return session.query(resources.user.models.User) \
+                  .filter(resources.user.models.User.username == username) \
+                  .limit(1).first()
+
+
+def _digest(token):
+    '''
+    Creates a digest of a token, so that plain tokens are never kept in memory by the cache.
+
+    :param token: the token as passed in the request
+    '''
+    if isinstance(token, unicode):
+        token = token.encode('utf-8')
+
+    return hashlib.sha256(token).digest()
+
+
 class Auth(object):
     '''
     A struct that contains authentication information, to be used by the endpoint.
     '''
 
-    def __init__(self, user=None):
+    def __init__(self, username, user_id, user=None, endpoint=None, by_token=False):
+        self._username = username
+        self._user_id = user_id
         self._user = user
+        self._endpoint = endpoint
+        self._by_token = by_token
+
+    @property
+    def username(self):
+        return self._username
+
+    @property
+    def user_id(self):
+        return self._user_id
+
+    @property
+    def by_token(self):
+        # whether the user was authenticated by a session token, rather than by their password
+        return self._by_token
 
     @property
     def user(self):
+        # lazily load the user, since most endpoints only need to know who the user is
+        if self._user is None:
+            self._user = self._endpoint.session.query(resources.user.models.User).get(self._user_id)
+
+            # a lagging replica may not have users who have just registered yet
+            if self._user is None and self._endpoint.reads_replica:
+                self._endpoint.use_primary()
+                self._user = self._endpoint.session.query(resources.user.models.User).get(self._user_id)
+
+            if self._user is None:
+                raise server.RestfulException(401, 'unauthorized')
+
         return self._user
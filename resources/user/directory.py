@@ -0,0 +1,141 @@
+import os
+import time
+import threading
+import collections
+
+import sqlalchemy
+
+import server
+import resources.user.models
+
+
+# a directory entry holds the public fields of a user, and can be rendered by the user's renderer
+Entry = collections.namedtuple('Entry', ['id', 'username', 'public_key', 'version'])
+
+
+class Directory(object):
+    '''
+    Caches the public fields of users by username, so that hot lookups (e.g. checking that the recipient of a message
+    exists, or fetching the public key of a friend) skip the db.
+
+    Misses are queried on the primary db, so that lagging replicas do not hide users who have just registered.
+    Concurrent misses of the same name are collapsed into a single query, whose result is shared by all of the waiting
+    lookups.
+
+    Names that were not found are cached for `missing_ttl` seconds, but only by the process that has created the
+    directory. Registration only invalidates the name in the registering process, so workers that are forked from it
+    (see `Server.serve`) never cache missing names, or they could miss users who have registered through others.
+
+    Public fields of users never change, but their version does (see `User.versioned`). A cached version may be
+    outdated, which only affects the tags of responses, not their contents.
+    '''
+
+    def __init__(self, max_size=65536, missing_ttl=0):
+        '''
+        :param max_size: maximal number of users (and of missing names) to hold
+        :param missing_ttl: seconds during which names that were not found are considered missing (0 to disable)
+        '''
+        self._missing_ttl = missing_ttl
+        self._pid = os.getpid()
+        self._entries = server.LRUCache(max_size=max_size)
+        self._missing = server.LRUCache(max_size=max_size)
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._lookups = 0
+        self._queries = 0
+        self._coalesced = 0
+
+    def lookup(self, get_session, username):
+        '''
+        :param get_session: a function that returns a session of the primary db to query with on a miss, e.g. the
+                            request's session, so that a miss does not take another connection. the session is left
+                            open
+        :param username: name of the user
+        :return: an `Entry` of the user, or None if the user does not exist
+        '''
+        with self._lock:
+            self._lookups += 1
+
+        entry = self._entries.get(username)
+        if entry is not None or self._missing.get(username, 0) > time.time():
+            return entry
+
+        # only one of the concurrent lookups of a missing name queries the db, and the others wait for its result
+        with self._lock:
+            flight = self._flights.get(username)
+            leading = flight is None
+
+            if leading:
+                flight = self._flights[username] = _Flight()
+                self._queries += 1
+            else:
+                self._coalesced += 1
+
+        if not leading:
+            flight.done.wait()
+
+            if flight.error is not None:
+                raise flight.error
+
+            return flight.entry
+
+        try:
+            flight.entry = self._query(get_session(), username)
+
+            if flight.entry is not None:
+                self._entries.set(username, flight.entry)
+            elif self._missing_ttl > 0 and self._pid == os.getpid():
+                self._missing.set(username, time.time() + self._missing_ttl)
+
+            return flight.entry
+
+        except Exception as err:
+            flight.error = err
+            raise
+
+        finally:
+            with self._lock:
+                del self._flights[username]
+
+            flight.done.set()
+
+    def invalidate(self, username):
+        '''
+        Drops a name from the directory, e.g. once it has been registered or its user has been updated.
+        '''
+        self._entries.invalidate(username)
+        self._missing.invalidate(username)
+
+    def stats(self):
+        '''
+        :return: a dict with the number of lookups, the rate of lookups answered without querying the db, the number
+                 of queries, of lookups that waited for a concurrent query, and of cached users
+        '''
+        with self._lock:
+            lookups, queries, coalesced = self._lookups, self._queries, self._coalesced
+
+        return {'lookups': lookups,
+                'hit_rate': float(lookups - queries) / lookups if lookups else 0.0,
+                'queries': queries,
+                'coalesced': coalesced,
+                'size': len(self._entries)}
+
+    def _query(self, session, username):
+        User = resources.user.models.User
+
+        statement = sqlalchemy.select(User.columns(*Entry._fields)).where(User.username == username)
+        records = server.select_records(session, statement)
+
+        return Entry(*records[0]) if records else None
+
+
+class _Flight(object):
+
+    def __init__(self):
+        self.entry = None
+        self.error = None
+        self.done = threading.Event()
+
+
+# the directory of this process
+user_directory = Directory(missing_ttl=10)
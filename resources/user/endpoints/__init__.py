@@ -1,3 +1,5 @@
 import register
+import login
 import me
 import friend
+import friend_batch
@@ -1,25 +1,29 @@
 import server
 import resources.user.models
 from resources.user.authentication import authenticate
+from resources.user.directory import user_directory
 
 
 class Endpoint(server.Endpoint):
 
     url = '/users/friends'
 
+    get_querystring_parser = server.QuerystringParser()
+    get_querystring_parser.add_argument('username', help='name of the friend to find', required=True)
+
+    @server.read_only
     @authenticate
     def get(self):
-        querystring_parser = server.QuerystringParser()
-        querystring_parser.add_argument('username', help='name of the friend to find', required=True)
-        querystring = querystring_parser.parse_args()
-
-        try:
-            user = self.session.query(resources.user.models.User) \
-                .filter(resources.user.models.User.username == querystring.username) \
-                .limit(1).all()[0]
-        except Exception:
+        querystring = Endpoint.get_querystring_parser.parse_args()
+        User = resources.user.models.User
+
+        # public fields of users are served by the directory, which only queries the db for names it does not know.
+        # it queries the primary db, since replicas may not have users who have just registered
+        self.use_primary()
+        entry = user_directory.lookup(lambda: self.session, querystring.username)
+        if entry is None:
             raise server.RestfulException(404, 'user not found')
 
-        return user.render()
-
+        self.conditional(User.etag(entry.id, entry.version))
 
+        return User.renderer()(entry)
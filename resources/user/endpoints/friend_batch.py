@@ -0,0 +1,55 @@
+import collections
+
+import sqlalchemy
+
+import server
+import resources.user.models
+from resources.user.authentication import authenticate
+
+
+class Endpoint(server.Endpoint):
+
+    url = '/users/friends/batch'
+
+    # maximal number of users that can be looked up in a single request
+    max_batch_size = 500
+
+    post_body_parser = server.BodyParser()
+    post_body_parser.add_argument('usernames', help='list of names of the friends to find', type=list, required=True)
+
+    @server.read_only
+    @authenticate
+    def post(self):
+        # parse request
+        body = Endpoint.post_body_parser.parse_args()
+
+        if not 0 < len(body.usernames) <= Endpoint.max_batch_size or \
+                not all(isinstance(username, basestring) for username in body.usernames):
+            raise server.RestfulException(400, 'invalid field "usernames": expected a list of 1 to {0} usernames'
+                                               .format(Endpoint.max_batch_size))
+
+        # find all users at once, loading only their rendered fields
+        requested = list(collections.OrderedDict.fromkeys(body.usernames))
+
+        found = self._find(requested)
+
+        # a lagging replica may not have users who have just registered yet
+        missing = [username for username in requested if username not in found]
+        if missing and self.reads_replica:
+            self.use_primary()
+            found.update(self._find(missing))
+
+        # return the users in the order they were requested, and the names of those that were not found
+        return {'users': [found[username] for username in requested if username in found],
+                'missing': [username for username in requested if username not in found]}
+
+    def _find(self, usernames):
+        '''
+        :param usernames: names of users
+        :return: a dict of the renderings of the users that were found, by username
+        '''
+        User = resources.user.models.User
+        render = User.renderer()
+
+        statement = sqlalchemy.select(User.columns(*User.rendered_fields())).where(User.username.in_(usernames))
+        return dict((record.username, render(record)) for record in server.select_records(self.session, statement))
@@ -0,0 +1,19 @@
+import server
+import resources.user.tokens
+from resources.user.authentication import authenticate
+
+
+class Endpoint(server.Endpoint):
+
+    url = '/users/login'
+
+    @authenticate
+    def post(self):
+        # tokens are only issued for passwords, otherwise a stolen token could be renewed indefinitely
+        if self.auth.by_token:
+            raise server.RestfulException(401, 'unauthorized')
+
+        # exchange the user's credentials for a short lived session token
+        token, expires_at = resources.user.tokens.issue(self.auth.username, self.auth.user_id)
+
+        return {'token': token, 'token_type': 'bearer', 'expires_at': expires_at}, 201
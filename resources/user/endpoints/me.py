@@ -1,21 +1,38 @@
 import server
-from resources.user.authentication import authenticate
+import resources.user.models
+from resources.user.authentication import authenticate, auth_cache
+from resources.user.directory import user_directory
 
 
 class Endpoint(server.Endpoint):
 
     url = '/users/me'
 
+    post_body_parser = server.BodyParser()
+    post_body_parser.add_argument('info', help='user private info, such as contacts list')
+    post_body_parser.add_argument('password', help='new password')
+
+    @server.read_only
     @authenticate
     def get(self):
-        return self.auth.user.render(with_private_fields=True)
+        User = resources.user.models.User
+
+        # the version of the user is checked first, so that an unmodified profile is not loaded
+        # a lagging replica may not have the user yet, in which case they are loaded from the primary db below
+        version = self.session.query(User.version).filter(User.id == self.auth.user_id).scalar()
+        if version is not None:
+            self.conditional(User.etag(self.auth.user_id, version, with_private_fields=True))
+
+        # tag the profile by the version it was loaded with, in case it has been updated in between
+        user = self.auth.user
+        self.conditional(User.etag(user.id, user.version, with_private_fields=True))
+
+        return user.render(with_private_fields=True)
 
     @authenticate
     def post(self):
         # parse body
-        body_parser = server.BodyParser()
-        body_parser.add_argument('info', help='user private info, such as contacts list')
-        body = body_parser.parse_args()
+        body = Endpoint.post_body_parser.parse_args()
 
         # since it is not mandatory to change any of the user's fields, this flag will indicate whether it has
         user_changed = False
@@ -25,6 +42,14 @@ class Endpoint(server.Endpoint):
             self.auth.user.info = body.info
             user_changed = True
 
+        # if password passed, replace it. only the current password may replace it, not a session token
+        if body.password is not None:
+            if self.auth.by_token:
+                raise server.RestfulException(401, 'unauthorized')
+
+            self.auth.user.set_password(body.password)
+            user_changed = True
+
         # if user has not changed anything, do not continue. it is not mandatory to change any one field, but it is
         # required to alter at least one - otherwise, the `get` method should be used
         if not user_changed:
@@ -38,5 +63,10 @@ class Endpoint(server.Endpoint):
         except:
             raise server.RestfulException(409, 'could not save info')
 
+        # drop cached authentication and version of the user, so that the next request observes the changes (e.g. is
+        # no longer authenticated by the old password)
+        auth_cache.invalidate(self.auth.username)
+        user_directory.invalidate(self.auth.username)
+
         # return user
         return self.auth.user.render(with_private_fields=True)
@@ -1,4 +1,5 @@
 import server
+import resources.user
 import resources.user.models
 
 
@@ -6,15 +7,19 @@ class Endpoint(server.Endpoint):
 
     url = '/users'
 
+    post_body_parser = server.BodyParser()
+    post_body_parser.add_argument('username', help='unique name of user', required=True)
+    post_body_parser.add_argument('password', help='desired password', required=True)
+    post_body_parser.add_argument('private_key', help='secret rsa key of user (encrypted)', required=True)
+    post_body_parser.add_argument('public_key', help='public rsa key of user (plain)', required=True)
+    post_body_parser.add_argument('info', help='user private info, such as contacts list')
+
     def post(self):
         # parse request
-        body_parser = server.BodyParser()
-        body_parser.add_argument('username', help='unique name of user', required=True)
-        body_parser.add_argument('password', help='desired password', required=True)
-        body_parser.add_argument('private_key', help='secret rsa key of user (encrypted)', required=True)
-        body_parser.add_argument('public_key', help='public rsa key of user (plain)', required=True)
-        body_parser.add_argument('info', help='user private info, such as contacts list')
-        body = body_parser.parse_args()
+        body = Endpoint.post_body_parser.parse_args()
+
+        # the new user reads their own writes, even if replicas have not caught up yet
+        self.consistency_key = body.username
 
         # create user
         try:
@@ -32,5 +37,8 @@ class Endpoint(server.Endpoint):
         except AssertionError:
             raise server.RestfulException(400, resources.user.models.User.assert_fail_reasons)
 
+        # the name may have been looked up (and found missing) before it was registered
+        resources.user.user_directory.invalidate(user.username)
+
         # return success
         return user.render(with_private_fields=True), 201
@@ -0,0 +1,19 @@
+from authentication import auth_cache
+from directory import user_directory
+
+
+def collect():
+    '''
+    :return: values of the caches of the user resource, by sample name (see `server.metrics.Metrics`)
+    '''
+    auth = auth_cache.stats()
+    directory = user_directory.stats()
+
+    return {'auth_cache_size': auth['size'],
+            'auth_cache_hits_total': auth['hits'],
+            'auth_cache_misses_total': auth['misses'],
+            'auth_cache_evictions_total': auth['evictions'],
+            'user_directory_size': directory['size'],
+            'user_directory_lookups_total': directory['lookups'],
+            'user_directory_queries_total': directory['queries'],
+            'user_directory_coalesced_total': directory['coalesced']}
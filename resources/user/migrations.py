@@ -0,0 +1,11 @@
+import server
+import server.migrations
+from resources.user.models import User
+
+
+migrations = [
+    server.Migration(1, 'add versions to users',
+                     lambda connection: server.migrations.ensure_columns(connection, User, 'version')),
+    server.Migration(2, 'index versions of users by id',
+                     lambda connection: server.migrations.ensure_indexes(connection, User, 'ix_users_id_version')),
+]
@@ -19,6 +19,12 @@ class User(server.Model):
     renders_fields = ['username', 'public_key']
     renders_private_fields = ['private_key', 'info']
 
+    # users are versioned, so that clients can revalidate the keys and profiles they have fetched (see `etag`).
+    # versions are indexed along with ids, so that profiles can be revalidated without reading the whole row. users
+    # that are looked up by name are served by the directory (see `user_directory`), which needs their whole entry.
+    versioned = True
+    indexes = [('id', 'version')]
+
     assert_fail_reasons = 'bad username, should be alphanumeric, not shorter than 3 and not longer than 32 characters'
     integrity_fail_reasons = 'username is already in use'
 
@@ -28,27 +34,22 @@ class User(server.Model):
         assert User.allowed_usernames.match(username)
 
         self.username = username
-        self.salt = self._create_salt()
-        self.password = self._hash_with_salt(password, self.salt)
+        self.set_password(password)
         self.private_key = private_key
         self.public_key = public_key
         self.info = info or ''
 
+    def set_password(self, password):
+        # a new salt is created along with every password
+        self.salt = self._create_salt()
+        self.password = self._hash_with_salt(password, self.salt)
+
     def check_password(self, password):
         if self.password == self._hash_with_salt(password, self.salt):
             return True
 
         return False
 
-    def render(self, with_private_fields=False, **kwargs):
-        user = super(User, self).render(**kwargs)
-
-        if with_private_fields:
-            for field in User.renders_private_fields:
-                user[field] = getattr(self, field)
-
-        return user
-
     def _create_salt(self):
         '''
         Generates a base64 encoded 128bit long cryptographically random salt.
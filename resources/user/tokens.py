@@ -0,0 +1,66 @@
+import hmac
+import time
+import base64
+import hashlib
+
+import flask
+
+
+# lifetime of issued tokens, in seconds
+TOKEN_TTL = 900
+
+
+def issue(username, user_id, ttl=TOKEN_TTL):
+    '''
+    Issues a signed session token for a user.
+
+    The token carries the identity of the user and its expiration time, and is signed with the server's secret, so
+    it can later be verified without accessing the db.
+
+    :param username: name of the user
+    :param user_id: id of the user
+    :param ttl: number of seconds the token is valid for
+    :return: a tuple of the token and its expiration unix timestamp
+    '''
+    expires_at = int(time.time()) + ttl
+    payload = '{0}:{1}:{2}'.format(username, user_id, expires_at)
+
+    token = '{0}.{1}'.format(base64.urlsafe_b64encode(payload), _sign(payload))
+    return token, expires_at
+
+
+def verify(token):
+    '''
+    Verifies a session token.
+
+    :param token: the token, as issued by `issue`
+    :return: a tuple of the username and user id the token was issued for, or None if the token is invalid or expired
+    '''
+    try:
+        if isinstance(token, unicode):
+            token = token.encode('ascii')
+
+        encoded_payload, encoded_signature = token.split('.')
+        payload = base64.urlsafe_b64decode(encoded_payload)
+
+        if not hmac.compare_digest(encoded_signature, _sign(payload)):
+            return None
+
+        username, user_id, expires_at = payload.split(':')
+        if int(expires_at) < time.time():
+            return None
+
+        return username, int(user_id)
+
+    except Exception:
+        return None
+
+
+def _sign(payload):
+    '''
+    Signs a payload using the secret of the running server.
+
+    :param payload: the string to sign
+    :return: the signature, base64 encoded
+    '''
+    return base64.urlsafe_b64encode(hmac.new(flask.current_app.secret_key, payload, hashlib.sha256).digest())
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+'''
+Benchmarks read/write concurrency on a sqlite db: readers polling for messages while writers send them, comparing
+the default engine (rollback journal, a new connection per session) to the tuned one (wal, pooled connections).
+
+Usage: ./scripts/bench_db.py [-d DURATION] [-r READERS] [-w WRITERS]
+'''
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import sqlalchemy
+import sqlalchemy.exc
+import sqlalchemy.orm
+
+import server
+import resources.user
+import resources.message
+import resources.group
+
+
+Message = resources.message.models.Message
+
+
+def reader(session_factory, deadline, stats):
+    statement = sqlalchemy.select(Message.columns(*Message.rendered_fields())) \
+                          .where(Message.to_user == 'avivbh') \
+                          .order_by(Message.id.desc()) \
+                          .limit(100)
+
+    while time.time() < deadline:
+        session = session_factory()
+        start = time.time()
+
+        try:
+            server.select_records(session, statement)
+            stats['latencies'].append(time.time() - start)
+        except sqlalchemy.exc.OperationalError:
+            stats['errors'] += 1
+        finally:
+            session.close()
+
+
+def writer(session_factory, deadline, stats):
+    while time.time() < deadline:
+        session = session_factory()
+        start = time.time()
+
+        try:
+            session.add(Message('roysom', 'avivbh', 'x' * 256))
+            session.commit()
+            stats['writes'] += 1
+            stats['write_latencies'].append(time.time() - start)
+        except sqlalchemy.exc.OperationalError:
+            session.rollback()
+            stats['errors'] += 1
+        finally:
+            session.close()
+
+
+def measure(engine, duration, readers, writers):
+    server.Model.metadata.create_all(engine)
+    session_factory = sqlalchemy.orm.sessionmaker(bind=engine)
+
+    session = session_factory()
+    session.bulk_save_objects([Message('roysom', 'avivbh', 'x' * 256) for _ in xrange(10000)])
+    session.commit()
+    session.close()
+
+    stats = {'latencies': [], 'write_latencies': [], 'writes': 0, 'errors': 0}
+    deadline = time.time() + duration
+
+    threads = [threading.Thread(target=reader, args=(session_factory, deadline, stats)) for _ in xrange(readers)]
+    threads += [threading.Thread(target=writer, args=(session_factory, deadline, stats)) for _ in xrange(writers)]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    engine.dispose()
+    return stats
+
+
+def percentile(values, fraction):
+    return sorted(values)[int(len(values) * fraction)] * 1000 if values else 0
+
+
+def report(name, stats, duration):
+    print '{0}: {1:.0f} reads/s (p99 {2:.1f}ms), {3:.0f} writes/s (p99 {4:.1f}ms), {5} lock errors'.format(
+        name, len(stats['latencies']) / duration, percentile(stats['latencies'], 0.99),
+        stats['writes'] / duration, percentile(stats['write_latencies'], 0.99), stats['errors'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--duration', help='seconds to run each measurement', type=float, default=5)
+    parser.add_argument('-r', '--readers', help='number of reading threads', type=int, default=8)
+    parser.add_argument('-w', '--writers', help='number of writing threads', type=int, default=2)
+    args = parser.parse_args()
+
+    tmp_path = tempfile.mkdtemp()
+
+    try:
+        url = 'sqlite:///{0}'.format(os.path.join(tmp_path, 'default.sqlite'))
+        report('default', measure(sqlalchemy.create_engine(url), args.duration, args.readers, args.writers),
+               args.duration)
+
+        url = 'sqlite:///{0}'.format(os.path.join(tmp_path, 'tuned.sqlite'))
+        report('tuned  ', measure(server.db.create_engine(url, pool_size=args.readers + args.writers),
+                                  args.duration, args.readers, args.writers), args.duration)
+    finally:
+        shutil.rmtree(tmp_path)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+'''
+Benchmarks the throughput of sending messages from concurrent senders, when each message is committed on its own
+compared to group commit (see `server.WriteBatcher`).
+
+The db uses the "durable" sqlite profile by default, where every commit is synced to disk.
+
+Usage: ./scripts/bench_group_commit.py [-m MESSAGES] [-s SENDERS [SENDERS ...]] [-p PROFILE]
+'''
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import server
+import resources.user
+import resources.message
+import resources.group
+
+
+Message = resources.message.models.Message
+
+
+def write_directly(session_factory):
+    def write(message):
+        session = session_factory()
+
+        try:
+            session.add(message)
+            session.commit()
+        finally:
+            session.close()
+
+    return write
+
+
+def write_batched(session_factory):
+    return server.WriteBatcher(session_factory).write
+
+
+def measure(url, profile, senders, messages, create_writer):
+    engine = server.db.create_engine(url, pool_size=min(senders, 32), max_overflow=senders, sqlite_profile=profile)
+    server.Model.metadata.create_all(engine)
+    write = create_writer(server.create_session_factory(engine))
+
+    per_sender = max(1, messages // senders)
+    errors = []
+
+    def sender():
+        for _ in xrange(per_sender):
+            try:
+                write(Message('roysom', 'avivbh', 'x' * 256))
+            except Exception as err:
+                errors.append(err)
+
+    threads = [threading.Thread(target=sender) for _ in xrange(senders)]
+
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    engine.dispose()
+    return (per_sender * senders - len(errors)) / elapsed, len(errors)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--messages', help='number of messages to send per measurement', type=int, default=2000)
+    parser.add_argument('-s', '--senders', help='numbers of concurrent senders', type=int, nargs='+',
+                        default=[10, 100, 1000])
+    parser.add_argument('-p', '--profile', help='sqlite profile of the db', default='durable',
+                        choices=sorted(server.SQLITE_PROFILES))
+    args = parser.parse_args()
+
+    tmp_path = tempfile.mkdtemp()
+
+    try:
+        for senders in args.senders:
+            results = []
+
+            for name, create_writer in [('direct', write_directly), ('batched', write_batched)]:
+                url = 'sqlite:///{0}'.format(os.path.join(tmp_path, '{0}-{1}.sqlite'.format(name, senders)))
+                results.append(measure(url, args.profile, senders, args.messages, create_writer))
+
+            (direct, direct_errors), (batched, batched_errors) = results
+            print '{0} senders: direct {1:.0f} msg/s ({2} failed), batched {3:.0f} msg/s ({4} failed), {5:.1f}x'.format(
+                senders, direct, direct_errors, batched, batched_errors, batched / direct)
+    finally:
+        shutil.rmtree(tmp_path)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+'''
+Benchmarks the notifier backends: how many notifications per second can be published, and how many deliveries per
+second are sustained when fanning out to multiple processes.
+
+Usage: ./scripts/bench_notifier.py [-c NOTIFICATIONS] [-w WORKERS]
+'''
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import server.notifier
+
+
+class CountingNotifier(server.notifier.Notifier):
+    '''
+    A notifier that counts the notifications it receives, and flags once it has received all of them.
+    '''
+
+    def __init__(self, backend, expected):
+        super(CountingNotifier, self).__init__(backend)
+        self.received = 0
+        self.expected = expected
+        self.done = multiprocessing.Event()
+
+    def _deliver(self, key):
+        super(CountingNotifier, self)._deliver(key)
+        self.received += 1
+        if self.received == self.expected:
+            self.done.set()
+
+
+def bench_local(count):
+    notifier = CountingNotifier(server.notifier.LocalBackend(), count)
+
+    start = time.time()
+    for i in xrange(count):
+        notifier.notify('user{0}'.format(i % 100))
+    elapsed = time.time() - start
+
+    print 'local:  published and delivered {0} notifications in {1:.3f}s ({2:.0f}/s)'.format(count, elapsed,
+                                                                                           count / elapsed)
+
+
+def bench_sqlite(count, workers, path):
+    backend = server.notifier.SqliteBackend(path, prune_every=count + 1)
+    ready = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+
+    def worker():
+        notifier = CountingNotifier(backend, count)
+        notifier.version('start')
+        ready.put(os.getpid())
+
+        notifier.done.wait(60)
+        results.put((notifier.received, time.time()))
+
+    processes = [multiprocessing.Process(target=worker) for _ in xrange(workers)]
+    for process in processes:
+        process.start()
+    for _ in processes:
+        ready.get()
+
+    start = time.time()
+    for i in xrange(count):
+        backend.publish('user{0}'.format(i % 100))
+    published = time.time() - start
+
+    received = [results.get() for _ in processes]
+    delivered = max(finished for _, finished in received) - start
+    total = sum(count for count, _ in received)
+
+    for process in processes:
+        process.join()
+
+    print 'sqlite: published {0} notifications in {1:.3f}s ({2:.0f}/s)'.format(count, published, count / published)
+    print 'sqlite: delivered {0}/{1} notifications to {2} workers in {3:.3f}s ({4:.0f} deliveries/s)'.format(
+        total, count * workers, workers, delivered, total / delivered)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--count', help='number of notifications to publish', type=int, default=10000)
+    parser.add_argument('-w', '--workers', help='number of subscribing worker processes', type=int, default=4)
+    args = parser.parse_args()
+
+    tmp_path = tempfile.mkdtemp()
+
+    try:
+        bench_local(args.count)
+        bench_sqlite(args.count, args.workers, os.path.join(tmp_path, 'notifications.sqlite'))
+    finally:
+        shutil.rmtree(tmp_path)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+'''
+Benchmarks reading and rendering messages through the orm, compared to reading them as plain records.
+
+Latency is measured per page, from query to rendered dicts. Allocations are measured as the number of objects tracked
+by the garbage collector that are held by a fetched page (python 2 has no allocation tracer), which accounts for orm
+instances, their state and the session's identity map.
+
+Usage: ./scripts/bench_records.py [-r REPEATS]
+'''
+import gc
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import sqlalchemy
+import sqlalchemy.orm
+
+import server
+import resources.user
+import resources.message
+import resources.group
+
+
+Message = resources.message.models.Message
+
+
+def fetch_orm(session, limit):
+    return session.query(Message).filter(Message.to_user == 'avivbh').order_by(Message.id).limit(limit).all()
+
+
+def render_orm(messages):
+    return [message.render() for message in messages]
+
+
+def fetch_records(session, limit):
+    statement = sqlalchemy.select(Message.columns(*Message.rendered_fields())) \
+                          .where(Message.to_user == 'avivbh') \
+                          .order_by(Message.id) \
+                          .limit(limit)
+
+    return server.select_records(session, statement)
+
+
+def render_records(messages):
+    render = Message.renderer()
+    return [render(message) for message in messages]
+
+
+def measure(session_factory, fetch, render, limit, repeats):
+    '''
+    :return: a tuple of the average milliseconds per page, and the number of objects held by a page
+    '''
+    elapsed = 0
+    for _ in xrange(repeats):
+        session = session_factory()
+
+        start = time.time()
+        render(fetch(session, limit))
+        elapsed += time.time() - start
+
+        session.close()
+
+    session = session_factory()
+    gc.collect()
+    before = len(gc.get_objects())
+    page = fetch(session, limit)
+    allocated = len(gc.get_objects()) - before
+
+    del page
+    session.close()
+
+    return elapsed / repeats * 1000, allocated
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--repeats', help='number of pages to fetch per measurement', type=int, default=20)
+    args = parser.parse_args()
+
+    engine = sqlalchemy.create_engine('sqlite://')
+    server.Model.metadata.create_all(engine)
+    session_factory = sqlalchemy.orm.sessionmaker(bind=engine)
+
+    session = session_factory()
+    session.bulk_save_objects([Message('roysom', 'avivbh', 'x' * 256) for _ in xrange(10000)])
+    session.commit()
+    session.close()
+
+    for limit in [100, 10000]:
+        orm_time, orm_objects = measure(session_factory, fetch_orm, render_orm, limit, args.repeats)
+        records_time, records_objects = measure(session_factory, fetch_records, render_records, limit, args.repeats)
+
+        print '{0} rows, orm:     {1:.2f}ms per page, {2} objects'.format(limit, orm_time, orm_objects)
+        print '{0} rows, records: {1:.2f}ms per page, {2} objects ({3:.1f}x faster, {4:.1f}x fewer objects)'.format(
+            limit, records_time, records_objects, orm_time / records_time, float(orm_objects) / records_objects)
@@ -1,12 +1,25 @@
+import os
+import time
+import shutil
+import tempfile
 import functools
 import flask
-import sqlalchemy
-import sqlalchemy.orm
 
-from endpoint import HTTP_METHODS, Endpoint
+from endpoint import HTTP_METHODS, Endpoint, read_only
 from parsers import BodyParser, HeadersParser, QuerystringParser
-from exception import RestfulException
-from model import Model, ModelField, ModelTypes, IntegrityError
+from exception import RestfulException, NotModified, RetryLater
+from model import Model, ModelField, ModelTypes, IntegrityError, select_records
+from cache import LRUCache
+from migrations import Migration, MigrationRunner
+from notifier import Notifier, LocalBackend, create_backend as create_notifier_backend
+from encoding import JsonEncoder, Stream
+from session import create_session_factory
+from db import create_engine, optimize as optimize_db, copy_sqlite, pool_stats, ReplicaSet, SQLITE_PROFILES
+from scheduler import Scheduler
+from batching import WriteBatcher
+from limits import RateLimiter, Admission
+from metrics import Metrics, sample_name
+import runner
 
 
 class Server(object):
@@ -14,19 +27,301 @@ class Server(object):
     def __init__(self, *args, **kwargs):
         self._app = flask.Flask(*args, **kwargs)
         self._app.errorhandler(404)(functools.partial(self._error_handler, 404, 'not found'))
+        self._app.errorhandler(405)(functools.partial(self._error_handler, 405, 'method not allowed'))
+        self._app.secret_key = os.urandom(32)
         self._sqlengine = None
         self._session = None
+        self._shard_engines = []
+        self._shard_sessions = []
+        self._write_batchers = []
+        self._replica_engines = []
+        self._replicas = ReplicaSet()
+        self._sqlite_replicas = []
+        self._migrations = MigrationRunner()
+        self._notifier = Notifier()
+        self._encoder = JsonEncoder()
+        self._scheduler = Scheduler(self._app.logger)
+        self._admission = Admission()
+        self._identify = None
+        self._metrics = Metrics()
+        self._metrics.add_collector(self._collect_metrics)
+        self._metrics_url = None
+        self._metrics_directory = None
 
     def run(self, port, debug=False):
         # initialize sql
-        Model.metadata.create_all(self._sqlengine)
+        self.migrate()
 
-        # start flask server
-        self._app.run('0.0.0.0', port, debug)
+        # start flask server. requests are handled on separate threads, so that long polling requests do not block
+        self._scheduler.start()
+        self._app.run('0.0.0.0', port, debug, threaded=True)
 
-    def use_db(self, url):
-        self._sqlengine = sqlalchemy.create_engine(url)
-        self._session = sqlalchemy.orm.sessionmaker(bind=self._sqlengine)
+    def serve(self, port, workers=1, shutdown_timeout=10):
+        '''
+        Runs the server in production mode, handling requests on separate threads of one or more worker processes.
+
+        The db is migrated once, before any worker is started. Multiple workers share the listening socket, and
+        require a notifier backend that is shared between processes (see `use_notifier`). Scheduled tasks are run by
+        the first worker only.
+
+        :param port: listening port number
+        :param workers: number of worker processes, or 1 to serve from the current process
+        :param shutdown_timeout: seconds to wait for in-flight requests when receiving SIGTERM or SIGINT
+        '''
+        self.migrate()
+
+        if workers > 1 and isinstance(self._notifier.backend, LocalBackend):
+            self._app.logger.warning('local notifications are not delivered across workers, use a shared backend')
+
+        # connections opened by the parent must not be shared with the workers
+        self._dispose_engines()
+
+        if workers <= 1:
+            self._scheduler.start()
+
+        # workers share their metrics through a directory, which is temporary unless set in `use_metrics`
+        metrics_directory = self._metrics_directory
+        if self._metrics_url is not None and workers > 1 and metrics_directory is None:
+            metrics_directory = tempfile.mkdtemp(prefix='metrics')
+
+        if metrics_directory is not None:
+            self._metrics.share(metrics_directory)
+            self._metrics.clear()
+
+        try:
+            runner.serve(self._app, '0.0.0.0', port, workers, shutdown_timeout, after_fork=self._after_fork)
+        finally:
+            self._scheduler.stop(shutdown_timeout)
+
+            if metrics_directory is not None and self._metrics_directory is None:
+                shutil.rmtree(metrics_directory, ignore_errors=True)
+
+    def migrate(self):
+        '''
+        Creates missing tables and applies pending migrations of the used resources to the db and its shards.
+        '''
+        if not self._shard_engines:
+            Model.metadata.create_all(self._sqlengine)
+            applied = self._migrations.run(self._sqlengine)
+
+        else:
+            # sharded tables live only on the shards, and all others only on the primary db
+            tables = Model.metadata.sorted_tables
+            Model.metadata.create_all(self._sqlengine, tables=[table for table in tables if not table.info['sharded']])
+
+            for engine in self._shard_engines:
+                Model.metadata.create_all(engine, tables=[table for table in tables if table.info['sharded']])
+
+            applied = sum((self._migrations.run(engine) for engine in [self._sqlengine] + self._shard_engines), [])
+
+        # sqlite replicas are copied right away, so that they are never behind the schema
+        for path in self._sqlite_replicas:
+            self._copy_sqlite_replica(path)
+
+        return applied
+
+    def use_db(self, url, pool_size=None, max_overflow=None, pool_recycle=None, pool_pre_ping=False,
+               sqlite_profile='durable', shards=None, replicas=None, read_your_writes=5):
+        '''
+        Sets the database of the server.
+
+        Models that are marked as sharded (i.e. messages) can be spread across multiple dbs, each with its own write
+        lock. Their rows are routed by a stable hash of a key chosen by the endpoint (see `Endpoint.shard`), while all
+        other models stay on the primary db. The pool options apply to each of the dbs.
+
+        Read only handlers (see `server.read_only`) read from replicas of the primary db, round robin, if there are
+        any. Replication itself is up to the db.
+
+        :param url: url of the primary database
+        :param pool_size: number of connections kept open by the pool
+        :param max_overflow: number of connections that may be opened beyond the pool size under load
+        :param pool_recycle: number of seconds after which connections are reopened
+        :param pool_pre_ping: whether to test connections as they are checked out, replacing ones that went stale
+        :param sqlite_profile: pragmas applied to sqlite connections, "durable" (default), "performance" or "none"
+        :param shards: list of urls of the shard dbs (optional, sharded models are stored on the primary db if not set)
+        :param replicas: list of urls of read replicas of the primary db (optional)
+        :param read_your_writes: seconds during which readers that have written read from the primary db rather than
+                                 from replicas, which may lag behind it. readers are identified by their
+                                 `Endpoint.consistency_key`, per process.
+        '''
+        options = (pool_size, max_overflow, pool_recycle, pool_pre_ping, sqlite_profile)
+
+        self._sqlengine = create_engine(url, *options)
+        self._session = create_session_factory(self._sqlengine)
+        self._shard_engines = [create_engine(shard_url, *options) for shard_url in shards or []]
+        self._shard_sessions = [create_session_factory(engine) for engine in self._shard_engines]
+
+        self._replicas = ReplicaSet(read_your_writes)
+        self._replica_engines = [create_engine(replica_url, *options) for replica_url in replicas or []]
+
+        for engine in self._replica_engines:
+            self._replicas.add(create_session_factory(engine))
+
+    def use_sqlite_replica(self, path, interval=1):
+        '''
+        Adds a stand-in for a read replica of a sqlite db, for testing replicas locally: a copy of the db, which is
+        replaced by a fresh copy every `interval` seconds. Must be called after `use_db`.
+
+        :param path: path of the copy
+        :param interval: seconds between copies, i.e. the replication lag
+        '''
+        # copies replace the file, so connections are not kept open, otherwise they would keep reading a stale one
+        engine = create_engine('sqlite:///{0}'.format(path), sqlite_profile='none', pooled=False)
+
+        self._replica_engines.append(engine)
+        self._replicas.add(create_session_factory(engine))
+        self._sqlite_replicas.append(path)
+
+        self.schedule('sqlite replica', interval, lambda session: self._copy_sqlite_replica(path))
+
+    def use_write_batching(self, max_delay=0.005, max_size=200):
+        '''
+        Groups concurrent writes that are made through `Endpoint.write` into shared transactions, so that bursts of
+        writes (e.g. of messages) are committed together rather than one by one. Each write still returns only once
+        its transaction has been committed.
+
+        Must be called after `use_db`.
+
+        :param max_delay: maximal number of seconds a write waits for others to join its transaction
+        :param max_size: maximal number of writes per transaction
+        '''
+        self._write_batchers = [WriteBatcher(session_factory, max_delay, max_size)
+                                for session_factory in [self._session] + self._shard_sessions]
+
+    def use_notifier(self, url):
+        '''
+        Sets the backend through which notifications (e.g. of new messages) are published.
+
+        By default, notifications are delivered in-process. When running multiple worker processes, a backend shared
+        by the workers must be used, so that a notification published by one worker wakes waiters of the others.
+
+        :param url: url of the backend, either "local" or "sqlite:///<path>"
+        '''
+        self._notifier.backend.close()
+        self._notifier = Notifier(create_notifier_backend(url))
+
+    def use_json_encoder(self, backend):
+        '''
+        Sets the json backend used for rendering responses.
+
+        :param backend: one of "ujson", "simplejson" or "stdlib", or "auto" for the fastest one installed (default)
+        '''
+        self._encoder = JsonEncoder(backend)
+
+    def use_secret(self, secret):
+        '''
+        Sets the secret used for signing data issued by the server, such as session tokens.
+
+        Unless set, a random secret is generated per server instance, meaning that signed data does not outlive it.
+
+        :param secret: the secret key
+        '''
+        self._app.secret_key = secret
+
+    def use_rate_limits(self, per_user=None, per_address=None, burst=None, identify=None):
+        '''
+        Limits the rate of requests of each user, and of each client address. Requests beyond the limit are answered
+        with 429, without opening a db session.
+
+        Users are identified before their request is handled, so they must be verified without the db (e.g. by a
+        signed token). Otherwise, anyone could exhaust the limit of a user by claiming to be them. Requests whose user
+        is not identified are only limited by their address.
+
+        Limits are applied per process, so when running multiple workers each of them allows the given rates.
+
+        :param per_user: requests per second allowed per identified user (optional)
+        :param per_address: requests per second allowed per client address, including anonymous requests such as
+                            registrations (optional)
+        :param burst: number of requests that may be made at once (defaults to a second's worth of requests)
+        :param identify: a function that receives the request, and returns the name of its user if it can be verified
+                         without the db, or None. required for limiting users
+        '''
+        if per_user and identify is None:
+            raise Exception('Limiting the rate of users requires a function that identifies them.')
+
+        self._admission.user_limiter = RateLimiter(per_user, burst) if per_user else None
+        self._admission.address_limiter = RateLimiter(per_address, burst) if per_address else None
+        self._identify = identify
+
+    def use_max_in_flight(self, max_in_flight, retry_after=1):
+        '''
+        Caps the number of requests handled at once by each process (including long polling ones). Requests beyond the
+        cap are answered with 503 rather than queued.
+
+        :param max_in_flight: maximal number of requests handled at once
+        :param retry_after: seconds after which rejected clients are told to retry
+        '''
+        self._admission.max_in_flight = max_in_flight
+        self._admission.retry_after = retry_after
+
+    def admission_stats(self):
+        '''
+        :return: stats of the requests admitted and rejected by this process (see `use_rate_limits`)
+        '''
+        return self._admission.stats()
+
+    def use_metrics(self, url='/metrics', directory=None):
+        '''
+        Exposes the metrics of the server (such as request counts and latencies, db pools and caches) on an endpoint,
+        in the prometheus text format. The endpoint is neither authenticated nor rate limited.
+
+        When serving from multiple workers, their metrics are shared through files in a directory and summed.
+
+        :param url: url of the endpoint
+        :param directory: path of the directory to share metrics through (optional, a temporary one is used if not set)
+        '''
+        self._metrics_url = url
+        self._metrics_directory = directory
+        self._app.add_url_rule(url, 'metrics', view_func=self._render_metrics, methods=['GET'])
+
+    def schedule(self, name, interval, task, dbs='primary'):
+        '''
+        Runs a task periodically in the background, e.g. in order to maintain the db.
+
+        The task is called with a new session of each of the dbs it is scheduled on, which is committed once the task
+        returns. Tasks can return a dict of counts (e.g. of removed rows), which are accumulated in `task_stats`.
+
+        :param name: name of the task
+        :param interval: seconds between consecutive runs
+        :param task: a function that receives a session, and optionally returns a dict of counts
+        :param dbs: "primary" for the primary db, "shards" for the dbs of sharded models (the primary db if the server
+                    is not sharded), or "all"
+        '''
+        def run():
+            counts = {}
+
+            for session_factory in self._session_factories(dbs):
+                session = session_factory()
+
+                try:
+                    for count_name, count in (task(session) or {}).iteritems():
+                        counts[count_name] = counts.get(count_name, 0) + count
+
+                    session.commit()
+                except:
+                    session.rollback()
+                    raise
+                finally:
+                    session.close()
+
+            return counts
+
+        self._scheduler.add(name, interval, run)
+
+    def use_maintenance(self, interval=3600, vacuum_pages=1024):
+        '''
+        Periodically vacuums and analyzes the dbs of the server (including shards). Only applies to sqlite dbs.
+
+        :param interval: seconds between maintenance runs
+        :param vacuum_pages: maximal number of free pages returned to the file system per db and run
+        '''
+        self.schedule('db maintenance', interval, functools.partial(optimize_db, vacuum_pages=vacuum_pages), dbs='all')
+
+    def task_stats(self):
+        '''
+        :return: stats of the scheduled tasks of this process, such as counts of the rows they have removed
+        '''
+        return self._scheduler.stats()
 
     def use_resource(self, resource):
         # add endpoints
@@ -42,58 +337,234 @@ class Server(object):
             if isinstance(possible_model_class, Model):
                 possible_model_class.__tablename__ = '{0}s'.format(possible_model_class.__name__.lower())
 
+        # add migrations
+        if hasattr(resource, 'migrations'):
+            self._migrations.add(resource.__name__, resource.migrations.migrations)
+
+        # add metrics
+        if hasattr(resource, 'metrics'):
+            self._metrics.add_collector(resource.metrics.collect)
+
     def _register_endpoint(self, name, cls):
         for method in HTTP_METHODS:
+            handler = getattr(cls, method).__func__
+
+            # only methods implemented by the endpoint are routed, others are answered with 405 by flask
+            if handler is getattr(Endpoint, method).__func__:
+                continue
+
             self._app.add_url_rule(cls.url,
                                    '{0}.{1}'.format(name, method),
-                                   view_func=functools.partial(self._endpoint_handler, cls, method),
+                                   view_func=self._create_view(cls, method, handler),
                                    methods=[method])
 
-    def _endpoint_handler(self, endpoint_cls, method, **uri_params):
-        request = flask.request
-        session = self._session()
+    def _create_view(self, endpoint_cls, method, handler):
+        # resolved once at registration, rather than on every request
+        read_only = getattr(handler, 'read_only', False)
+
+        def view(**uri_params):
+            # werkzeug routes HEAD to GET handlers as well, which may block (e.g. long polling) only to send no body
+            if flask.request.method.lower() != method:
+                return self._error_handler(405, 'method not allowed')
 
+            return self._endpoint_handler(endpoint_cls, handler, read_only, **uri_params)
+
+        # otherwise flask answers OPTIONS on its own
+        view.provide_automatic_options = False
+
+        return view
+
+    def _endpoint_handler(self, endpoint_cls, handler, read_only, **uri_params):
+        started_at = time.time()
+
+        # requests are admitted before any work is done on their behalf, so that rejecting them is cheap
         try:
-            # create instance and attach fields
-            endpoint_instance = endpoint_cls()
-            endpoint_instance.request = request
-            endpoint_instance.session = session
+            user = self._identify(flask.request) if self._admission.user_limiter is not None else None
+            self._admission.enter(user, flask.request.remote_addr)
+        except RetryLater as err:
+            response = self._error_handler(err.status, err.message, err)
+            return self._on_response_sent(response, endpoint_cls, handler, started_at)
+
+        try:
+            response = self._handle_request(endpoint_cls, handler, read_only, **uri_params)
+        except:
+            self._admission.leave()
+            raise
+
+        return self._on_response_sent(response, endpoint_cls, handler, started_at, self._admission.leave)
 
+    def _handle_request(self, endpoint_cls, handler, read_only, **uri_params):
+        # create instance and attach fields. the session is only created if the handler uses it
+        endpoint_instance = endpoint_cls()
+        endpoint_instance.request = flask.request
+        endpoint_instance.session_factory = self._session
+        endpoint_instance.shard_session_factories = self._shard_sessions
+        endpoint_instance.write_batchers = self._write_batchers
+        endpoint_instance.replicas = self._replicas
+        endpoint_instance.notifier = self._notifier
+        endpoint_instance.read_only = read_only
+
+        try:
             # run endpoint handler
-            response = getattr(endpoint_instance, method)(**uri_params)
+            response = handler(endpoint_instance, **uri_params)
 
-            # commit session and close
-            session.commit()
-            session.close()
+            # streamed responses are rendered while the session is still open, since rendering them may load data
+            if Stream.is_streamed(response[0] if isinstance(response, tuple) else response):
+                return self._render_stream(response, endpoint_instance)
+
+            # commit pending changes, if there are any, and close the session
+            endpoint_instance.release_session()
+
+            # run callbacks that depend on the changes being committed
+            self._run_after_commit(endpoint_instance)
 
             # return the outcome
-            return self._render_response(response)
+            return self._render_response(response, endpoint_instance.etag, endpoint_instance.cache_control)
+
+        except NotModified:
+            endpoint_instance.discard_session()
+
+            # the client already has the resource, so it is neither rendered nor sent
+            response = flask.Response(status=304)
+            return self._tag_response(response, endpoint_instance.etag, endpoint_instance.cache_control)
 
         except RestfulException as err:
             # rollback any changes
-            session.rollback()
-            session.close()
+            endpoint_instance.discard_session()
 
             # return rendered exception
             return self._error_handler(err.status, err.message, err)
 
         except Exception as err:
             # rollback any changes
-            session.rollback()
-            session.close()
+            endpoint_instance.discard_session()
 
             # return rendered exception with 500
             return self._error_handler(500, err.message, err)
 
+    def _on_response_sent(self, response, endpoint_cls, handler, started_at, callback=None):
+        rendered = response[0] if isinstance(response, tuple) else response
+
+        # requests are in flight until their response has been sent, which matters for streamed ones. by then, the
+        # status of the response has been set by flask.
+        def on_close():
+            if callback is not None:
+                callback()
+
+            self._metrics.observe(endpoint_cls.url, handler.__name__.upper(), rendered.status_code,
+                                  time.time() - started_at)
+
+        rendered.call_on_close(on_close)
+        return response
+
+    def _render_metrics(self):
+        return flask.Response(self._metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    def _collect_metrics(self):
+        values = {'http_requests_in_flight': self._admission.stats()['in_flight']}
+
+        engines = [('primary', self._sqlengine)] + \
+                  [('shard{0}'.format(index), engine) for index, engine in enumerate(self._shard_engines)] + \
+                  [('replica{0}'.format(index), engine) for index, engine in enumerate(self._replica_engines)]
+
+        for db, engine in engines:
+            stats = pool_stats(engine) if engine is not None else None
+
+            for name, value in (stats or {}).iteritems():
+                values[sample_name('db_pool_{0}'.format(name), db=db)] = value
+
+        for task, stats in self._scheduler.stats().iteritems():
+            values[sample_name('task_runs_total', task=task)] = stats['runs']
+            values[sample_name('task_failures_total', task=task)] = stats['failures']
+
+            for count_name, count in stats['counts'].iteritems():
+                values[sample_name('task_counts_total', task=task, count=count_name)] = count
+
+        return values
+
+    def _session_factories(self, dbs):
+        if dbs == 'primary' or (dbs == 'shards' and not self._shard_sessions):
+            return [self._session]
+
+        return ([self._session] if dbs == 'all' else []) + self._shard_sessions
+
+    def _after_fork(self, worker_index):
+        self._dispose_engines()
+
+        # tasks are run by a single worker, so that they do not compete with each other
+        if worker_index == 0:
+            self._scheduler.start()
+
+    def _dispose_engines(self):
+        for engine in [self._sqlengine] + self._shard_engines + self._replica_engines:
+            engine.dispose()
+
+    def _copy_sqlite_replica(self, path):
+        session = self._session()
+
+        try:
+            copy_sqlite(session, path)
+        finally:
+            session.close()
+
+    def _run_after_commit(self, endpoint_instance):
+        # readers that have just written are served by the primary db for a while, so that they observe their writes
+        if endpoint_instance.consistency_key is not None and endpoint_instance.has_written:
+            self._replicas.wrote(endpoint_instance.consistency_key)
+
+        for callback in endpoint_instance.after_commit_callbacks:
+            try:
+                callback()
+            except Exception:
+                # the request has already succeeded, so failing callbacks are only logged
+                self._app.logger.exception('after commit callback failed')
+
     def _error_handler(self, status, message, err=None):
-        return flask.jsonify({'status': status, 'message': message}), status
+        headers = {'Retry-After': str(err.retry_after)} if isinstance(err, RetryLater) else {}
+        return self._render_response(({'status': status, 'message': message}, status, headers))
 
-    def _render_response(self, response):
+    def _render_response(self, response, etag=None, cache_control=None):
         if isinstance(response, tuple):
             response = list(response)
-            response[0] = flask.jsonify(response[0])
+            response[0] = self._tag_response(flask.Response(self._encoder.dumps(response[0]),
+                                                            mimetype='application/json'),
+                                             etag, cache_control)
             response = tuple(response)
         else:
-            response = flask.jsonify(response)
+            response = self._tag_response(flask.Response(self._encoder.dumps(response), mimetype='application/json'),
+                                          etag, cache_control)
+
+        return response
+
+    def _tag_response(self, response, etag=None, cache_control=None):
+        if etag is not None:
+            response.set_etag(etag)
+
+        if cache_control is not None:
+            response.headers['Cache-Control'] = cache_control
 
         return response
+
+    def _render_stream(self, response, endpoint_instance):
+        response = list(response) if isinstance(response, tuple) else [response]
+        body = Stream.of(response[0])
+
+        def stream():
+            try:
+                for chunk in self._encoder.iterencode(body):
+                    yield chunk
+
+                endpoint_instance.release_session()
+                self._run_after_commit(endpoint_instance)
+
+            except Exception:
+                # the status has already been sent, so there is nothing left to do but to abort
+                self._app.logger.exception('streamed response failed')
+                raise
+
+            finally:
+                # a no-op if the session has already been released, otherwise its changes are rolled back
+                endpoint_instance.discard_session()
+
+        response[0] = flask.Response(stream(), mimetype='application/json')
+        return tuple(response)
@@ -0,0 +1,135 @@
+import os
+import time
+import threading
+
+import sqlalchemy.exc
+
+import server.exception
+
+
+class WriteBatcher(object):
+    '''
+    Groups concurrent writes into shared transactions (group commit), so that a burst of writes costs a few commits
+    rather than one commit each.
+
+    Writers block until the transaction of their write has been committed. A transaction is committed once it has
+    `max_size` writes, or `max_delay` seconds after its first write has been submitted.
+    '''
+
+    # seconds a write may wait to be taken into a transaction beyond `max_delay`, which covers previous transactions
+    # that wait for a busy db
+    commit_timeout = 10
+
+    def __init__(self, session_factory, max_delay=0.005, max_size=200):
+        '''
+        :param session_factory: factory of sessions of the db to write to
+        :param max_delay: maximal number of seconds a write waits for others to join its transaction
+        :param max_size: maximal number of writes per transaction
+        '''
+        self._session_factory = session_factory
+        self._max_delay = max_delay
+        self._max_size = max_size
+        self._pending = []
+        self._condition = threading.Condition()
+        self._pid = None
+        self._thread = None
+
+    def write(self, instance):
+        '''
+        Adds a model instance to the next transaction, and waits until it has been committed.
+
+        :param instance: the model instance to insert or update
+        :return: the instance, detached from any session, with its fields loaded (e.g. its id)
+        :raise RestfulException: with 503, if the write was not taken into a transaction in time
+        '''
+        write = _Write(instance)
+
+        with self._condition:
+            # the flushing thread is started lazily per process, since threads do not survive forking. it is restarted
+            # if it has died, rather than leaving writers waiting for it
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._pending = []
+                self._thread = None
+
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name='write batcher')
+                self._thread.daemon = True
+                self._thread.start()
+
+            self._pending.append(write)
+            self._condition.notify_all()
+
+        if not write.done.wait(self._max_delay + WriteBatcher.commit_timeout):
+            # writes that are still pending are dropped, so that they are never committed once they have failed
+            with self._condition:
+                queued = write in self._pending
+                if queued:
+                    self._pending.remove(write)
+
+            if queued:
+                raise server.exception.RestfulException(503, 'write timed out')
+
+            # a write that has already been taken into a transaction may still be committed, so its outcome is awaited
+            write.done.wait()
+
+        if write.error is not None:
+            raise write.error
+
+        return instance
+
+    def _loop(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+
+                # wait for more writes to join, up to the delay of the first one
+                deadline = time.time() + self._max_delay
+                while len(self._pending) < self._max_size and time.time() < deadline:
+                    self._condition.wait(deadline - time.time())
+
+                batch = self._pending[:self._max_size]
+                self._pending = self._pending[self._max_size:]
+
+            self._commit(batch)
+
+    def _commit(self, batch):
+        try:
+            self._commit_transaction(batch)
+        except sqlalchemy.exc.IntegrityError:
+            # a single invalid write fails the whole transaction, so the writes are retried one by one, in order for
+            # the others to succeed
+            for write in batch:
+                try:
+                    self._commit_transaction([write])
+                except Exception as err:
+                    write.error = err
+        except Exception as err:
+            # other errors (e.g. a locked db) would fail the retries just the same
+            for write in batch:
+                write.error = err
+        finally:
+            for write in batch:
+                write.done.set()
+
+    def _commit_transaction(self, batch):
+        session = self._session_factory(expire_on_commit=False)
+
+        try:
+            session.add_all(write.instance for write in batch)
+            session.commit()
+            session.expunge_all()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+
+class _Write(object):
+
+    def __init__(self, instance):
+        self.instance = instance
+        self.error = None
+        self.done = threading.Event()
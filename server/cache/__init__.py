@@ -0,0 +1,111 @@
+import time
+import threading
+import collections
+
+
+class LRUCache(object):
+    '''
+    A bounded, thread safe, in-process cache with least-recently-used eviction and an optional time-to-live.
+
+    It is meant for memoizing small, hot values (such as authentication results) across requests handled by the
+    same process. It keeps hit and miss counters, so its efficiency can be inspected at runtime.
+    '''
+
+    # sentinel used to tell apart a missing key from a cached None
+    _missing = object()
+
+    def __init__(self, max_size=1024, ttl=None):
+        '''
+        :param max_size: maximal number of entries to hold before evicting the least recently used one
+        :param ttl: number of seconds an entry is considered valid for (optional, entries never expire if not set)
+        '''
+        if max_size < 1:
+            raise Exception('Invalid cache size {0}: must hold at least one entry.'.format(max_size))
+
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key, default=None):
+        '''
+        Gets a value from the cache, and marks it as recently used.
+
+        :param key: key of the entry
+        :param default: value to return if the key is not cached or has expired
+        '''
+        with self._lock:
+            entry = self._entries.pop(key, LRUCache._missing)
+
+            if entry is not LRUCache._missing and (entry[1] is None or entry[1] > time.time()):
+                self._entries[key] = entry
+                self._hits += 1
+                return entry[0]
+
+            self._misses += 1
+            return default
+
+    def peek(self, key, default=None):
+        '''
+        Gets a value from the cache, without marking it as recently used or counting a hit or a miss.
+
+        :param key: key of the entry
+        :param default: value to return if the key is not cached or has expired
+        '''
+        with self._lock:
+            entry = self._entries.get(key, LRUCache._missing)
+
+            if entry is not LRUCache._missing and (entry[1] is None or entry[1] > time.time()):
+                return entry[0]
+
+            return default
+
+    def set(self, key, value):
+        '''
+        Stores a value in the cache, evicting the least recently used entry if the cache is full.
+
+        :param key: key of the entry
+        :param value: value to store
+        '''
+        expires_at = time.time() + self._ttl if self._ttl is not None else None
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires_at)
+
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def invalidate(self, key):
+        '''
+        Removes an entry from the cache, if it exists.
+
+        :param key: key of the entry
+        '''
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        '''
+        Removes all entries from the cache. Counters are kept.
+        '''
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        '''
+        :return: a dict with the current size of the cache, and its hit, miss and eviction counters
+        '''
+        with self._lock:
+            return {'size': len(self._entries),
+                    'max_size': self._max_size,
+                    'hits': self._hits,
+                    'misses': self._misses,
+                    'evictions': self._evictions}
+
+    def __len__(self):
+        return len(self._entries)
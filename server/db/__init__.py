@@ -0,0 +1,236 @@
+import os
+import zlib
+import itertools
+
+import sqlalchemy
+import sqlalchemy.exc
+import sqlalchemy.pool
+import sqlalchemy.event
+import sqlalchemy.engine.url
+
+import server.cache
+
+
+# pragmas applied to every new sqlite connection, per profile.
+# wal lets readers proceed while a message is being written. "durable" (the default) syncs on every commit, as sqlite
+# does by default. "performance" is opt-in: its "normal" synchronization is durable in wal mode except for the last
+# transactions before a power loss.
+# incremental auto vacuum (see `optimize`) only takes effect on dbs that are created with it.
+SQLITE_PROFILES = {
+    'performance': [('auto_vacuum', 'INCREMENTAL'),
+                    ('journal_mode', 'WAL'),
+                    ('synchronous', 'NORMAL'),
+                    ('mmap_size', 256 * 1024 * 1024),
+                    ('cache_size', -64 * 1024),
+                    ('busy_timeout', 5000)],
+    'durable': [('auto_vacuum', 'INCREMENTAL'),
+                ('journal_mode', 'WAL'),
+                ('synchronous', 'FULL'),
+                ('busy_timeout', 5000)],
+    'none': []
+}
+
+
+def create_engine(url, pool_size=None, max_overflow=None, pool_recycle=None, pool_pre_ping=False,
+                  sqlite_profile='durable', pooled=True):
+    '''
+    Creates an engine, configuring its connection pool and, for sqlite, tuning its connections.
+
+    :param url: url of the database
+    :param pool_size: number of connections kept open by the pool (default by sqlalchemy if not set)
+    :param max_overflow: number of connections that may be opened beyond the pool size under load
+    :param pool_recycle: number of seconds after which connections are reopened, for dbs that drop idle connections
+    :param pool_pre_ping: whether to test connections as they are checked out, replacing ones that went stale
+    :param sqlite_profile: name of the pragmas profile (one of SQLITE_PROFILES) applied to sqlite connections
+    :param pooled: whether to keep connections open, rather than opening one per session
+    '''
+    url = sqlalchemy.engine.url.make_url(url)
+    is_sqlite = url.get_backend_name() == 'sqlite'
+    in_memory = is_sqlite and url.database in (None, '', ':memory:')
+
+    kwargs = {}
+
+    # in memory sqlite dbs live and die with their connection, so their pool cannot be configured
+    if not in_memory:
+        options = {'pool_size': pool_size, 'max_overflow': max_overflow, 'pool_recycle': pool_recycle}
+        kwargs.update((name, value) for name, value in options.iteritems() if value is not None)
+
+    if not pooled:
+        kwargs = {'poolclass': sqlalchemy.pool.NullPool}
+
+    elif is_sqlite and not in_memory:
+        # sqlite file dbs are not pooled by default, meaning that every session opens (and tunes) a new connection.
+        # connections are only used by one thread at a time, so they can be safely shared between threads.
+        kwargs['poolclass'] = sqlalchemy.pool.QueuePool
+        kwargs['connect_args'] = {'check_same_thread': False}
+
+    engine = sqlalchemy.create_engine(url, **kwargs)
+
+    if is_sqlite:
+        pragmas = SQLITE_PROFILES[sqlite_profile]
+
+        if in_memory:
+            pragmas = [(name, value) for name, value in pragmas if name != 'journal_mode']
+
+        if pragmas:
+            sqlalchemy.event.listen(engine, 'connect', lambda connection, record: _apply_pragmas(connection, pragmas))
+
+    if pool_pre_ping:
+        sqlalchemy.event.listen(engine, 'engine_connect', _ping_connection)
+
+    return engine
+
+
+def optimize(session, vacuum_pages=1024):
+    '''
+    Performs periodic maintenance of a sqlite db: returns free pages (e.g. of deleted messages) to the file system,
+    and refreshes the statistics used by the query planner. Other dbs maintain themselves, so this is a no-op for them.
+
+    Pages are vacuumed incrementally, so that the db is never locked for long. Dbs that were created without
+    incremental auto vacuum are only analyzed.
+
+    :param session: session of the db
+    :param vacuum_pages: maximal number of pages to vacuum
+    :return: a dict with the number of vacuumed pages
+    '''
+    if session.bind.dialect.name != 'sqlite':
+        return {}
+
+    connection = session.connection()
+    vacuumed = 0
+
+    # 2 stands for incremental auto vacuum
+    if connection.execute('PRAGMA auto_vacuum').scalar() == 2:
+        free_pages = connection.execute('PRAGMA freelist_count').scalar()
+
+        # a page is vacuumed per step of the statement, so it is stepped through the raw cursor until it is done
+        cursor = connection.connection.cursor()
+        cursor.execute('PRAGMA incremental_vacuum({0})'.format(int(vacuum_pages)))
+        cursor.fetchall()
+        cursor.close()
+
+        vacuumed = free_pages - connection.execute('PRAGMA freelist_count').scalar()
+
+    # statistics are sampled from a limited number of rows per index, so that analyzing large tables is quick
+    connection.execute('PRAGMA analysis_limit=1000').fetchall()
+    connection.execute('ANALYZE')
+
+    return {'vacuumed_pages': vacuumed}
+
+
+def shard_index(key, shard_count):
+    '''
+    Maps a key to a shard. the mapping is stable across processes and restarts, unlike python's `hash`.
+
+    :param key: the key by which rows are sharded (e.g. the recipient of a message)
+    :param shard_count: number of shards
+    :return: index of the shard
+    '''
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+
+    return (zlib.crc32(key) & 0xffffffff) % shard_count
+
+
+def copy_sqlite(session, path):
+    '''
+    Copies a sqlite db to a file, replacing it atomically. Used as a stand-in for replication when testing locally.
+
+    :param session: session of the db to copy
+    :param path: path of the copy
+    '''
+    tmp_path = '{0}.tmp'.format(path)
+
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    session.connection().execute('VACUUM INTO ?', tmp_path)
+    os.rename(tmp_path, path)
+
+
+def pool_stats(engine):
+    '''
+    :param engine: an engine created by `create_engine`
+    :return: a dict with the size of the connection pool of the engine, and its number of checked out, idle and
+             overflowing connections, or None if the engine does not keep connections open
+    '''
+    pool = engine.pool
+
+    if not isinstance(pool, sqlalchemy.pool.QueuePool):
+        return None
+
+    return {'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'checked_in': pool.checkedin(),
+            'overflow': max(pool.overflow(), 0)}
+
+
+class ReplicaSet(object):
+    '''
+    Routes reads to replicas of a db, round robin.
+
+    Keys (e.g. users) that have recently written to the primary db are routed to it instead for a while, so that they
+    observe their own writes regardless of replication lag.
+    '''
+
+    def __init__(self, read_your_writes=5):
+        '''
+        :param read_your_writes: seconds during which keys that have written read from the primary db
+        '''
+        self._session_factories = []
+        self._counter = itertools.count()
+        self._recent_writes = server.cache.LRUCache(max_size=65536, ttl=read_your_writes)
+
+    def __len__(self):
+        return len(self._session_factories)
+
+    def add(self, session_factory):
+        self._session_factories.append(session_factory)
+
+    def session_factory(self, key=None):
+        '''
+        :param key: the key of the reader, if any
+        :return: the session factory of the next replica, or None if the reader should read from the primary db
+        '''
+        if not self._session_factories or (key is not None and self._recent_writes.get(key)):
+            return None
+
+        return self._session_factories[next(self._counter) % len(self._session_factories)]
+
+    def wrote(self, key):
+        '''
+        Marks a key as having written to the primary db.
+        '''
+        self._recent_writes.set(key, True)
+
+
+def _apply_pragmas(connection, pragmas):
+    cursor = connection.cursor()
+
+    for name, value in pragmas:
+        cursor.execute('PRAGMA {0}={1}'.format(name, value))
+
+    cursor.close()
+
+
+def _ping_connection(connection, branch):
+    '''
+    Tests a connection as it is checked out. if it has been dropped by the db, the pool is invalidated and the
+    statement is retried on a new connection.
+    '''
+    # sub-connections share the connection that has already been tested
+    if branch:
+        return
+
+    should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+
+    try:
+        connection.scalar(sqlalchemy.select([1]))
+    except sqlalchemy.exc.DBAPIError as err:
+        if err.connection_invalidated:
+            connection.scalar(sqlalchemy.select([1]))
+        else:
+            raise
+    finally:
+        connection.should_close_with_result = should_close_with_result
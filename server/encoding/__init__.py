@@ -0,0 +1,130 @@
+import json
+import types
+import functools
+
+
+# json backends, in order of preference. the faster ones are optional dependencies, and are only used if installed.
+BACKENDS = ['ujson', 'simplejson', 'stdlib']
+
+
+class JsonEncoder(object):
+    '''
+    Serializes responses into json, using one of the supported backends.
+    '''
+
+    # number of list items serialized into each chunk of a streamed response
+    stream_chunk_size = 64
+
+    def __init__(self, backend='auto'):
+        '''
+        :param backend: name of the backend (one of BACKENDS), or "auto" to pick the fastest installed one
+        '''
+        candidates = BACKENDS if backend == 'auto' else [backend]
+
+        for candidate in candidates:
+            try:
+                self._dumps = _load_backend(candidate)
+                self._backend = candidate
+                break
+            except ImportError:
+                continue
+        else:
+            raise Exception('Json backend {0} is not installed.'.format(backend))
+
+    @property
+    def backend(self):
+        return self._backend
+
+    def dumps(self, obj):
+        '''
+        :param obj: a json serializable object
+        :return: the json string of the object
+        '''
+        return self._dumps(obj)
+
+    def iterencode(self, stream):
+        '''
+        Serializes a stream incrementally, so that its items are never all held in memory.
+
+        :param stream: a Stream object
+        :return: a generator of json string chunks
+        '''
+        if stream.envelope is not None:
+            # the items are spliced into an array that is placed at the end of the rendered envelope
+            prefix, suffix = self._split_envelope(stream.envelope, stream.key)
+            yield prefix
+        else:
+            suffix = ''
+
+        yield '['
+
+        chunk = []
+        first = True
+        for item in stream.items:
+            chunk.append(self._dumps(item))
+
+            if len(chunk) == JsonEncoder.stream_chunk_size:
+                yield ('' if first else ',') + ','.join(chunk)
+                chunk = []
+                first = False
+
+        if chunk:
+            yield ('' if first else ',') + ','.join(chunk)
+
+        yield ']' + suffix
+
+    def _split_envelope(self, envelope, key):
+        '''
+        Renders an envelope, leaving room for the streamed array as its last value.
+
+        :return: a tuple of the json preceding the streamed array, and the json following it
+        '''
+        others = dict((name, value) for name, value in envelope.iteritems() if name != key)
+        rendered = self._dumps(others)
+
+        prefix = rendered[:-1] + (',' if others else '') + self._dumps(key) + ':'
+        return prefix, '}'
+
+
+class Stream(object):
+    '''
+    A response that is rendered incrementally as it is sent, rather than being materialized in memory.
+
+    Endpoints can return either a Stream, or a plain generator (which is rendered as a json array).
+    '''
+
+    def __init__(self, items, envelope=None, key=None):
+        '''
+        :param items: an iterable of json serializable items, rendered as a json array
+        :param envelope: a dict to place the array in (optional, the array is rendered on its own if not set)
+        :param key: the key of the array within the envelope
+        '''
+        if envelope is not None and key is None:
+            raise Exception('A key is required in order to stream items within an envelope.')
+
+        self.items = items
+        self.envelope = envelope
+        self.key = key
+
+    @staticmethod
+    def is_streamed(body):
+        return isinstance(body, (Stream, types.GeneratorType))
+
+    @staticmethod
+    def of(body):
+        return body if isinstance(body, Stream) else Stream(body)
+
+
+def _load_backend(name):
+    if name == 'ujson':
+        import ujson
+        return functools.partial(ujson.dumps, escape_forward_slashes=False)
+
+    if name == 'simplejson':
+        import simplejson
+        return functools.partial(simplejson.dumps, separators=(',', ':'))
+
+    if name == 'stdlib':
+        return functools.partial(json.dumps, separators=(',', ':'))
+
+    raise ImportError('Unknown json backend: {0}'.format(name))
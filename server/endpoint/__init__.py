@@ -1,3 +1,5 @@
+import server.db
+import server.session
 import server.exception
 
 
@@ -11,7 +13,16 @@ class Endpoint(object):
     Each of the methods below represents a handler that is automatically registered as a flask route.
     
     Whenever a route is invoked, a new Endpoint instance is created. Therefore, endpoint classes CAN be stateful.
-    Each of the created instances has two local variables: self.request and self.session attached to it.
+    Each of the created instances has the following local variables attached to it: self.request, self.session and
+    self.notifier (the server's notification hub, see `server.Notifier`).
+
+    The db session is only created once the handler accesses `self.session`, and is committed after the handler
+    returns only if it has pending changes. Handlers decorated with `read_only` are never committed. The same goes
+    for the sessions of shards, which are accessed through `self.shard`.
+
+    If the server has read replicas, the session of read only handlers is taken from one of them. Handlers should
+    set `self.consistency_key` (e.g. to the name of the authenticated user) before accessing the session, so that
+    readers who have just written are served by the primary db and observe their own writes.
     '''
 
     # the url for which the methods will be registered.
@@ -19,6 +30,197 @@ class Endpoint(object):
     # uri parts are passed as keyword arguments to the handlers.
     url = '/'
 
+    def __init__(self):
+        self.request = None
+        self.session_factory = None
+        self.shard_session_factories = []
+        self.write_batchers = []
+        self.replicas = None
+        self.consistency_key = None
+        self.etag = None
+        self.cache_control = None
+        self.notifier = None
+        self.read_only = False
+        self.after_commit_callbacks = []
+        self._session = None
+        self._shard_sessions = {}
+        self._batched_writes = False
+        self._primary = False
+        self._replica = False
+
+    @property
+    def session(self):
+        # the session is created on first access, so that requests which never touch the db do not pay for it
+        if self._session is None:
+            session_factory = self.session_factory
+
+            if self.read_only and self.replicas and not self._primary:
+                session_factory = self.replicas.session_factory(self.consistency_key) or session_factory
+
+            self._replica = session_factory is not self.session_factory
+            self._session = self._create_session(session_factory)
+
+        return self._session
+
+    @property
+    def reads_replica(self):
+        '''
+        Whether the request's session is taken from a read replica, which may lag behind the primary db. Handlers that
+        do not find rows which may have just been written (e.g. users who have just registered) should retry on the
+        primary db (see `use_primary`).
+        '''
+        return self._session is not None and self._replica
+
+    @property
+    def has_session(self):
+        return self._session is not None or bool(self._shard_sessions)
+
+    @property
+    def has_written(self):
+        '''
+        Whether the request has committed any changes (so far).
+        '''
+        return self._batched_writes or any(server.session.has_committed_writes(session)
+                                           for session in self._open_sessions())
+
+    def shard(self, key):
+        '''
+        Returns the session of the shard that stores the rows of sharded models (e.g. messages) for a key.
+
+        Rows should be sharded by a key that scopes all of the queries on them (e.g. the recipient of messages), so
+        that each query is answered by a single shard. If the server has no shards, this is the primary session.
+
+        :param key: the key by which rows are sharded
+        '''
+        if not self.shard_session_factories:
+            return self.session
+
+        index = server.db.shard_index(key, len(self.shard_session_factories))
+
+        if index not in self._shard_sessions:
+            self._shard_sessions[index] = self._create_session(self.shard_session_factories[index])
+
+        return self._shard_sessions[index]
+
+    def write(self, instance, shard_key=None):
+        '''
+        Inserts or updates a model instance and commits it right away, along with any pending changes of its session.
+
+        If the server batches writes (see `Server.use_write_batching`), the instance is instead committed in a
+        transaction shared with concurrent writes, and the request's sessions are released (see `release_session`)
+        while waiting for it. Either way, this returns once the instance has been committed.
+
+        :param instance: the model instance
+        :param shard_key: the key by which the instance is sharded, if its model is sharded (see `shard`)
+        :return: the instance, detached from the session with its fields loaded (e.g. its id)
+        '''
+        if self.read_only:
+            raise Exception('Cannot write from a read only handler.')
+
+        if self.write_batchers:
+            index = 0
+            if shard_key is not None and len(self.write_batchers) > 1:
+                index = 1 + server.db.shard_index(shard_key, len(self.write_batchers) - 1)
+
+            # waiting writers must not hold connections, or they could starve the batcher of them
+            self.release_session()
+            self._batched_writes = True
+            return self.write_batchers[index].write(instance)
+
+        session = self.shard(shard_key) if shard_key is not None else self.session
+        session.add(instance)
+        session.flush()
+
+        # detached before committing, so that committing does not expire (and later reload) its fields
+        session.expunge(instance)
+        session.commit()
+
+        return instance
+
+    def commit_shards(self, sessions):
+        '''
+        Commits the sessions of multiple shards (see `shard`), one after the other.
+
+        Shards are not committed atomically, so handlers should flush the changes of all shards before committing any
+        of them, in order for most failures (e.g. integrity errors) to be raised while nothing has been committed. A
+        shard that fails to commit is rolled back, and the others are committed regardless.
+
+        :param sessions: sessions of the shards
+        :return: the sessions that failed to commit
+        '''
+        failed = []
+
+        for session in sessions:
+            try:
+                session.commit()
+            except Exception:
+                session.rollback()
+                failed.append(session)
+
+        return failed
+
+    def conditional(self, etag, cache_control='private, no-cache'):
+        '''
+        Tags the response with an entity tag, and answers with 304 (not modified) right away if the client already
+        has the tagged representation (i.e. sent it in `If-None-Match`).
+
+        Handlers should call this as soon as the tag is known (e.g. from the version of a row, see `Model.etag`), so
+        that unmodified resources are neither loaded nor rendered.
+
+        :param etag: a strong entity tag, unquoted
+        :param cache_control: value of the Cache-Control header of the response. by default, clients may keep the
+                              response, but must revalidate it on every use
+        '''
+        self.etag = etag
+        self.cache_control = cache_control
+
+        if self.request.if_none_match.contains_weak(etag):
+            raise server.exception.NotModified()
+
+    def after_commit(self, callback):
+        '''
+        Registers a callback to be called once the request's changes have been committed successfully.
+
+        :param callback: a function that receives no arguments
+        '''
+        self.after_commit_callbacks.append(callback)
+
+    def release_session(self):
+        '''
+        Commits the pending changes of the request's sessions (including shards), and returns their connections to the
+        pool.
+
+        Handlers that block for long (e.g. long polling) should call this before blocking, so that they do not hold a
+        db connection or transaction while idle. The session can still be used afterwards, in which case a new
+        connection is acquired.
+        '''
+        for session in self._open_sessions():
+            if server.session.has_pending_writes(session):
+                session.commit()
+
+            session.close()
+
+    def use_primary(self):
+        '''
+        Releases the request's sessions (see `release_session`), and serves the rest of the request from the primary
+        db, even if the handler is read only.
+
+        Handlers should call this before reading rows that other requests have just been notified about (e.g. new
+        messages), since replicas may not have caught up with them yet.
+        '''
+        self.release_session()
+        self._session = None
+        self._primary = True
+        self._replica = False
+
+    def discard_session(self):
+        '''
+        Rolls back the changes of the request's sessions (including shards), and returns their connections to the pool.
+        '''
+        for session in self._open_sessions():
+            session.rollback()
+            session.close()
+
     def get(self, **uri_parts):
         self._method_not_allowed()
 
@@ -40,5 +242,26 @@ class Endpoint(object):
     def patch(self, **uri_parts):
         self._method_not_allowed()
 
+    def _create_session(self, factory):
+        session = factory()
+
+        if self.read_only:
+            server.session.set_read_only(session)
+
+        return session
+
+    def _open_sessions(self):
+        return ([self._session] if self._session is not None else []) + self._shard_sessions.values()
+
     def _method_not_allowed(self):
         raise server.exception.RestfulException(405, 'method not allowed')
+
+
+def read_only(func):
+    '''
+    Marks an endpoint handler as read only. Its session is never committed, and flushing changes through it fails.
+
+    :param func: endpoint handler
+    '''
+    func.read_only = True
+    return func
@@ -15,3 +15,27 @@ class RestfulException(Exception):
     @property
     def message(self):
         return self._message
+
+
+class NotModified(RestfulException):
+    '''
+    Denotes that the resource has not changed since the client has fetched it, which is answered with an empty 304.
+    '''
+
+    def __init__(self):
+        super(NotModified, self).__init__(304, 'not modified')
+
+
+class RetryLater(RestfulException):
+    '''
+    Denotes that the request was rejected in order to protect the server (e.g. by rate limiting), and should be retried
+    after a while. It is answered with a Retry-After header.
+    '''
+
+    def __init__(self, status, message, retry_after):
+        super(RetryLater, self).__init__(status, message)
+        self._retry_after = retry_after
+
+    @property
+    def retry_after(self):
+        return self._retry_after
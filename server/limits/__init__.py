@@ -0,0 +1,125 @@
+import math
+import time
+import threading
+import collections
+
+from server.exception import RetryLater
+
+
+class RateLimiter(object):
+    '''
+    Limits the rate of requests per key (e.g. per user or per client address) using token buckets.
+
+    Each key may make `burst` requests at once, and regains tokens at `rate` per second. Only the most recently used
+    keys are tracked, so that the memory of the limiter is bounded. A key that is evicted starts over with a full
+    bucket.
+    '''
+
+    def __init__(self, rate, burst=None, max_keys=65536):
+        '''
+        :param rate: number of requests per second allowed per key
+        :param burst: number of requests a key may make at once (defaults to a second's worth of requests)
+        :param max_keys: maximal number of keys to track
+        '''
+        if rate <= 0:
+            raise Exception('Invalid rate {0}: must be positive.'.format(rate))
+
+        self._rate = float(rate)
+        self._burst = float(burst if burst is not None else max(rate, 1))
+        self._max_keys = max_keys
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        '''
+        Takes a token from the bucket of a key.
+
+        :param key: key to limit by
+        :return: 0 if a token was taken, otherwise the number of seconds until one is available
+        '''
+        now = time.time()
+
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (self._burst, now))
+            tokens = min(self._burst, tokens + (now - updated_at) * self._rate)
+
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / self._rate
+
+            self._buckets[key] = (tokens, now)
+
+            while len(self._buckets) > self._max_keys:
+                self._buckets.popitem(last=False)
+
+        return wait
+
+
+class Admission(object):
+    '''
+    Decides whether requests are handled, before any work is done on their behalf.
+
+    Requests are rejected with 429 once their user or client address exceeds its rate limit, and with 503 once the
+    process handles too many requests at once, rather than queueing without limit. Both are answered with a
+    Retry-After header. Limits are applied per process.
+    '''
+
+    def __init__(self):
+        self.user_limiter = None
+        self.address_limiter = None
+        self.max_in_flight = None
+        self.retry_after = 1
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._admitted = 0
+        self._limited = 0
+        self._shed = 0
+
+    def enter(self, user, address):
+        '''
+        Admits a request, which must be followed by `leave` once it has been handled.
+
+        :param user: name of the requesting user, or None if it is anonymous or has not been verified
+        :param address: address of the requesting client
+        :raise RetryLater: if the request is rejected
+        '''
+        wait = 0
+
+        # the address is checked first, so that requests it rejects are not charged to the user
+        if self.address_limiter is not None:
+            wait = self.address_limiter.acquire(address)
+
+        if not wait and self.user_limiter is not None and user is not None:
+            wait = self.user_limiter.acquire(user)
+
+        with self._lock:
+            if wait:
+                self._limited += 1
+            elif self.max_in_flight is not None and self._in_flight >= self.max_in_flight:
+                self._shed += 1
+            else:
+                self._in_flight += 1
+                self._admitted += 1
+                return
+
+        if wait:
+            raise RetryLater(429, 'too many requests', int(math.ceil(wait)))
+
+        raise RetryLater(503, 'server is busy', self.retry_after)
+
+    def leave(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    def stats(self):
+        '''
+        :return: a dict with the number of requests currently handled, and the number of admitted, rate limited and
+                 shed requests
+        '''
+        with self._lock:
+            return {'in_flight': self._in_flight,
+                    'admitted': self._admitted,
+                    'limited': self._limited,
+                    'shed': self._shed}
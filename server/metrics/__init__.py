@@ -0,0 +1,240 @@
+import os
+import json
+import time
+import errno
+import bisect
+import threading
+
+
+# upper bounds of the request latency buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Metrics(object):
+    '''
+    Collects metrics of the requests handled by the process, and renders them in the prometheus text format.
+
+    Requests are counted, and their latency is recorded in a histogram, per endpoint, method and status. Other values
+    (e.g. of connection pools and caches) are gathered from collectors when the metrics are rendered. A collector is a
+    function that returns a dict of values by sample name (see `sample_name`). Samples whose name ends with "_total"
+    are counters, and the others are gauges.
+
+    When serving from multiple processes, each of them periodically writes a snapshot of its metrics to a shared
+    directory, and the snapshots of all processes are summed when rendering. Gauges of processes that have exited are
+    dropped, while their counters are kept.
+    '''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        '''
+        :param buckets: upper bounds of the latency buckets, in seconds
+        '''
+        self._buckets = tuple(buckets)
+        self._requests = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._directory = None
+        self._flush_interval = None
+        self._pid = None
+
+    def add_collector(self, collector):
+        '''
+        :param collector: a function that returns a dict of values by sample name
+        '''
+        self._collectors.append(collector)
+
+    def share(self, directory, flush_interval=1):
+        '''
+        Shares the metrics of this process with other processes through a directory. Snapshots left by previous runs
+        should be removed beforehand (see `clear`).
+
+        :param directory: path of the directory, or None to stop sharing
+        :param flush_interval: seconds between snapshots
+        '''
+        self._directory = directory
+        self._flush_interval = flush_interval
+
+    def clear(self):
+        '''
+        Removes the snapshots of all processes from the shared directory.
+        '''
+        for path in self._snapshot_paths():
+            os.remove(path)
+
+    def observe(self, endpoint, method, status, seconds):
+        '''
+        Records a handled request.
+
+        :param endpoint: url rule of the endpoint
+        :param method: http method of the request
+        :param status: status of the response
+        :param seconds: time it took to handle the request
+        '''
+        key = (endpoint, method, status)
+
+        with self._lock:
+            # the flushing thread is started lazily per process, since threads do not survive forking
+            if self._directory is not None and self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._requests = {}
+                thread = threading.Thread(target=self._flush_loop, name='metrics')
+                thread.daemon = True
+                thread.start()
+
+            series = self._requests.get(key)
+            if series is None:
+                series = self._requests[key] = [0, 0.0] + [0] * (len(self._buckets) + 1)
+
+            series[0] += 1
+            series[1] += seconds
+            series[2 + bisect.bisect_left(self._buckets, seconds)] += 1
+
+    def snapshot(self):
+        '''
+        :return: a json serializable dict of the metrics of this process
+        '''
+        values = {}
+        for collector in self._collectors:
+            values.update(collector())
+
+        with self._lock:
+            requests = [list(key) + series for key, series in self._requests.iteritems()]
+
+        return {'pid': os.getpid(), 'buckets': self._buckets, 'requests': requests, 'values': values}
+
+    def render(self):
+        '''
+        :return: the metrics of all processes, in the prometheus text format
+        '''
+        if self._directory is None:
+            return _render(self._buckets, [self.snapshot()])
+
+        # the snapshot of this process is refreshed, so that it is up to date when scraped
+        self._flush()
+        return _render(self._buckets, self._load_snapshots())
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self._flush_interval)
+
+            try:
+                self._flush()
+            except Exception:
+                # e.g. the directory has been removed during shutdown, and the next flush may succeed
+                pass
+
+    def _flush(self):
+        path = os.path.join(self._directory, '{0}.json'.format(os.getpid()))
+        temp_path = '{0}.tmp'.format(path)
+
+        with open(temp_path, 'w') as snapshot_file:
+            json.dump(self.snapshot(), snapshot_file)
+
+        # renamed into place, so that readers never see partially written snapshots
+        os.rename(temp_path, path)
+
+    def _load_snapshots(self):
+        snapshots = []
+
+        for path in self._snapshot_paths():
+            try:
+                with open(path) as snapshot_file:
+                    snapshot = json.load(snapshot_file)
+            except (IOError, ValueError):
+                continue
+
+            if snapshot['buckets'] != list(self._buckets):
+                continue
+
+            if not _is_alive(snapshot['pid']):
+                snapshot['values'] = dict((name, value) for name, value in snapshot['values'].iteritems()
+                                          if _is_counter(name))
+
+            snapshots.append(snapshot)
+
+        return snapshots
+
+    def _snapshot_paths(self):
+        if self._directory is None:
+            return []
+
+        return [os.path.join(self._directory, name) for name in os.listdir(self._directory) if name.endswith('.json')]
+
+
+def sample_name(name, **labels):
+    '''
+    :param name: name of the metric
+    :param labels: labels of the sample
+    :return: the name of the sample, as rendered in the prometheus text format
+    '''
+    if not labels:
+        return name
+
+    return u'{0}{{{1}}}'.format(name, u','.join(u'{0}="{1}"'.format(label, _escape(value))
+                                             for label, value in sorted(labels.iteritems())))
+
+
+def _render(buckets, snapshots):
+    requests = {}
+    values = {}
+
+    for snapshot in snapshots:
+        for series in snapshot['requests']:
+            key = tuple(series[:3])
+            totals = requests.setdefault(key, [0] * (len(series) - 3))
+            for index, value in enumerate(series[3:]):
+                totals[index] += value
+
+        for name, value in snapshot['values'].iteritems():
+            values[name] = values.get(name, 0) + value
+
+    lines = []
+
+    if requests:
+        lines.append('# TYPE http_requests_total counter')
+        for (endpoint, method, status), series in sorted(requests.iteritems()):
+            lines.append(u'{0} {1}'.format(sample_name('http_requests_total', endpoint=endpoint, method=method,
+                                                      status=status), series[0]))
+
+        lines.append('# TYPE http_request_duration_seconds histogram')
+        for (endpoint, method, status), series in sorted(requests.iteritems()):
+            labels = {'endpoint': endpoint, 'method': method, 'status': status}
+
+            # buckets are recorded separately, but rendered cumulatively
+            cumulative = 0
+            for bound, count in zip([repr(float(bound)) for bound in buckets] + ['+Inf'], series[2:]):
+                cumulative += count
+                lines.append(u'{0} {1}'.format(sample_name('http_request_duration_seconds_bucket', le=bound, **labels),
+                                              cumulative))
+
+            lines.append(u'{0} {1!r}'.format(sample_name('http_request_duration_seconds_sum', **labels), series[1]))
+            lines.append(u'{0} {1}'.format(sample_name('http_request_duration_seconds_count', **labels), series[0]))
+
+    # samples of the same metric are grouped under a single type line
+    typed = set()
+    for name, value in sorted(values.iteritems()):
+        metric = name.split('{', 1)[0]
+
+        if metric not in typed:
+            typed.add(metric)
+            lines.append('# TYPE {0} {1}'.format(metric, 'counter' if _is_counter(metric) else 'gauge'))
+
+        lines.append(u'{0} {1}'.format(name, value))
+
+    return '\n'.join(lines) + '\n'
+
+
+def _is_counter(name):
+    return name.split('{', 1)[0].endswith('_total')
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+
+    return True
+
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
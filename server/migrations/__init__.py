@@ -0,0 +1,129 @@
+import time
+import sqlalchemy
+
+
+# bookkeeping table for applied migrations. it lives outside of the models' metadata, since it is not a model.
+_metadata = sqlalchemy.MetaData()
+_schema_migrations = sqlalchemy.Table('schema_migrations', _metadata,
+                                      sqlalchemy.Column('namespace', sqlalchemy.String(128), primary_key=True),
+                                      sqlalchemy.Column('version', sqlalchemy.Integer, primary_key=True),
+                                      sqlalchemy.Column('description', sqlalchemy.String(256)),
+                                      sqlalchemy.Column('applied_at', sqlalchemy.Integer))
+
+
+class Migration(object):
+    '''
+    Declares a schema migration to be applied by the server.
+
+    Creating tables is done automatically by the server, but altering existing ones (e.g. adding indexes or columns to
+    a live db) is not. Resources declare such changes as a list of migrations, ordered by version.
+
+    Migrations are applied only once per db, but should still be idempotent: on a fresh db the tables are created
+    according to the latest models, so the changes described by the migration may already be in place.
+
+    If the server is sharded, migrations are applied to each of its dbs, and should skip tables that do not live in
+    the migrated db (as `ensure_indexes` and `ensure_columns` do).
+    '''
+
+    def __init__(self, version, description, upgrade):
+        '''
+        :param version: an integer, unique within the resource, that determines the order of migrations
+        :param description: short human readable description of the migration
+        :param upgrade: a function that receives a connection and applies the migration
+        '''
+        self.version = version
+        self.description = description
+        self.upgrade = upgrade
+
+
+class MigrationRunner(object):
+    '''
+    Applies pending migrations to a db, and keeps track of the applied ones in the `schema_migrations` table.
+    '''
+
+    def __init__(self):
+        self._migrations = {}
+
+    def add(self, namespace, migrations):
+        '''
+        Adds a set of migrations to the runner.
+
+        :param namespace: name of the set (usually the resource), versions are tracked separately per namespace
+        :param migrations: list of Migration objects
+        '''
+        versions = [migration.version for migration in migrations]
+        if len(set(versions)) != len(versions):
+            raise Exception('Migrations of {0} have conflicting versions.'.format(namespace))
+
+        self._migrations[namespace] = sorted(migrations, key=lambda migration: migration.version)
+
+    def run(self, engine):
+        '''
+        Applies all pending migrations, each in its own transaction.
+
+        :param engine: the engine of the db to migrate
+        :return: list of (namespace, version) tuples of the applied migrations
+        '''
+        _metadata.create_all(engine)
+
+        with engine.connect() as connection:
+            applied = set((row.namespace, row.version) for row in connection.execute(_schema_migrations.select()))
+
+        done = []
+        for namespace, migrations in sorted(self._migrations.iteritems()):
+            for migration in migrations:
+                if (namespace, migration.version) in applied:
+                    continue
+
+                with engine.begin() as connection:
+                    migration.upgrade(connection)
+                    connection.execute(_schema_migrations.insert(), namespace=namespace,
+                                                                    version=migration.version,
+                                                                    description=migration.description,
+                                                                    applied_at=int(time.time()))
+
+                done.append((namespace, migration.version))
+
+        return done
+
+
+def ensure_indexes(connection, model, *names):
+    '''
+    Creates indexes declared by a model, unless they already exist in the db.
+
+    :param connection: connection to the db
+    :param model: the model class
+    :param names: names of the indexes to create (optional, all of the model's indexes are created if not set)
+    '''
+    # tables that do not live in this db (e.g. sharded ones on the primary db) are skipped
+    if not connection.dialect.has_table(connection, model.__tablename__):
+        return
+
+    existing = set(index['name'] for index in sqlalchemy.inspect(connection).get_indexes(model.__tablename__))
+
+    for index in model.__table__.indexes:
+        if index.name not in existing and (not names or index.name in names):
+            index.create(connection)
+
+
+def ensure_columns(connection, model, *names):
+    '''
+    Adds columns declared by a model to its table, unless they already exist in the db.
+
+    Only columns which are nullable or have a server side default can be added to a populated table.
+
+    :param connection: connection to the db
+    :param model: the model class
+    :param names: names of the columns to add
+    '''
+    if not connection.dialect.has_table(connection, model.__tablename__):
+        return
+
+    existing = set(column['name'] for column in sqlalchemy.inspect(connection).get_columns(model.__tablename__))
+    compiler = connection.dialect.ddl_compiler(connection.dialect, None)
+
+    for name in names:
+        if name not in existing:
+            column = model.__table__.columns[name]
+            connection.execute('ALTER TABLE {0} ADD COLUMN {1}'.format(model.__tablename__,
+                                                                       compiler.get_column_specification(column)))
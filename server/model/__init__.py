@@ -1,4 +1,7 @@
-from sqlalchemy import ForeignKey
+import operator
+import collections
+
+from sqlalchemy import ForeignKey, Index
 import sqlalchemy.types as ModelTypes
 import sqlalchemy.ext.declarative as _declerative
 from sqlalchemy.schema import Column as ModelField
@@ -21,14 +24,34 @@ class _Base(object):
     def __tablename__(cls):
         return '{0}s'.format(cls.__name__.lower())
 
-    # autoincrement should not reuse old ids, even on sqlite
+    # autoincrement should not reuse old ids, even on sqlite.
+    # indexes are generated according to the `indexes` list of the class.
     @_declerative.declared_attr
     def __table_args__(cls):
-        return {'sqlite_autoincrement': True}
+        tablename = '{0}s'.format(cls.__name__.lower())
+        indexes = tuple(Index('ix_{0}_{1}'.format(tablename, '_'.join(fields)), *fields) for fields in cls.indexes)
+
+        return indexes + ({'sqlite_autoincrement': True, 'info': {'sharded': cls.sharded}},)
+
+    # inheriting classes can set this flag in order to keep a version number per row, which is incremented whenever
+    # the row is updated through the orm. versions are used for tagging rendered rows (see `etag`).
+    versioned = False
 
     # inheriting classes can override this list with the name of fields it should render
     renders_fields = []
 
+    # inheriting classes can override this list with the name of fields it should render only when asked to render
+    # private fields (e.g. when the user views their own profile)
+    renders_private_fields = []
+
+    # inheriting classes can override this list with tuples of field names, each describing a (composite) index.
+    # indexes are named after the table and their fields, e.g. `ix_messages_to_user_sent_at`.
+    indexes = []
+
+    # inheriting classes can set this flag in order to store their rows on the shards of the server (if it has any,
+    # see `Server.use_db`) rather than on its primary db. endpoints access the shards through `Endpoint.shard`.
+    sharded = False
+
     # inheriting classes can override this string with possible reasons for integrity exceptions,
     # so endpoints can catch such exceptions and use this string to describe the possible reasons.
     integrity_fail_reasons = ''
@@ -36,20 +59,124 @@ class _Base(object):
     # all models have an auto-incrementing integer id as primary key
     id = ModelField(ModelTypes.Integer, primary_key=True, autoincrement=True, )
 
-    def render(self, **kwargs):
+    @_declerative.declared_attr
+    def version(cls):
+        if cls.versioned:
+            return ModelField(ModelTypes.Integer, nullable=False, server_default='1')
+
+    @_declerative.declared_attr
+    def __mapper_args__(cls):
+        return {'version_id_col': cls.__table__.columns['version']} if cls.versioned else {}
+
+    def render(self, with_private_fields=False, **kwargs):
         '''
         Creates a dict representation, which later can be returned to user as json. 
+
+        :param with_private_fields: whether to render the private fields of the model as well
         '''
-        output = {}
+        return type(self).renderer(with_private_fields)(self)
 
-        for field in self.renders_fields + ['id']:
-            field_value = getattr(self, field)
-            if hasattr(field_value, 'render') and isinstance(field_value.render, callable):
-                output[field] = field_value.render()
-            else:
-                output[field] = field_value
+    @classmethod
+    def rendered_fields(cls, with_private_fields=False):
+        '''
+        :param with_private_fields: whether to include the private fields of the model
+        :return: list of the names of the fields rendered by the model
+        '''
+        return cls.renders_fields + (cls.renders_private_fields if with_private_fields else []) + ['id']
+
+    @classmethod
+    def columns(cls, *fields):
+        '''
+        :param fields: names of fields of the model
+        :return: list of the columns of the fields, to be used in core selects
+        '''
+        return [cls.__table__.columns[field] for field in fields]
+
+    @classmethod
+    def renderer(cls, with_private_fields=False):
+        '''
+        Gets the render function of the model, which is created once per model class rather than reflecting on the
+        rendered fields whenever an instance is rendered.
+
+        Rendered fields are expected to be plain columns.
+
+        :param with_private_fields: whether the function should render the private fields of the model as well
+        :return: a function that receives an instance and returns its dict representation
+        '''
+        # renderers are kept on the class itself, so that they are not shared with inheriting classes
+        renderers = cls.__dict__.get('_renderers')
+        if renderers is None:
+            renderers = {}
+            setattr(cls, '_renderers', renderers)
+
+        if with_private_fields not in renderers:
+            renderers[with_private_fields] = _create_renderer(cls.rendered_fields(with_private_fields))
+
+        return renderers[with_private_fields]
+
+    @classmethod
+    def etag(cls, id, version, with_private_fields=False):
+        '''
+        Creates a strong entity tag of the rendering of a versioned row (see `Endpoint.conditional`), which changes
+        whenever the row does.
+
+        :param id: id of the row
+        :param version: version of the row
+        :param with_private_fields: whether the rendering includes the private fields of the model
+        '''
+        return '{0}-{1}-{2}{3}'.format(cls.__tablename__, id, version, '-private' if with_private_fields else '')
+
+
+def _create_renderer(fields):
+    '''
+    Creates a function that renders the given fields of an object into a dict.
+
+    :param fields: list of field names
+    '''
+    fields = tuple(fields)
+
+    # the getter of a single field returns its value, rather than a tuple of values
+    get_values = operator.attrgetter(*fields)
+    if len(fields) == 1:
+        return lambda obj: {fields[0]: get_values(obj)}
+
+    return lambda obj: dict(zip(fields, get_values(obj)))
+
+
+def select_records(session, statement):
+    '''
+    Runs a read only select through the session, without constructing orm objects.
+
+    Rows are returned as compact records (namedtuples, which have no per-instance dict), whose fields are named after
+    the columns of the select. Records are not tracked by the session, and can be rendered directly by a model's
+    renderer, as long as the select has all of the rendered fields:
+
+        statement = sqlalchemy.select(Message.columns(*Message.rendered_fields())).where(...)
+        rendered = [Message.renderer()(record) for record in select_records(session, statement)]
+
+    :param session: the session to run the select with
+    :param statement: a sqlalchemy core select
+    :return: list of records
+    '''
+    result = session.execute(statement)
+    record_type = _record_type(tuple(result.keys()))
+
+    return [record_type._make(row) for row in result]
+
+
+_record_types = {}
+
+
+def _record_type(fields):
+    '''
+    Gets a record type for a set of fields. Record types are created once per set of fields.
+
+    :param fields: tuple of field names
+    '''
+    if fields not in _record_types:
+        _record_types[fields] = collections.namedtuple('Record', fields)
 
-        return output
+    return _record_types[fields]
 
 
 Model = _declerative.declarative_base(cls=_Base)
@@ -0,0 +1,291 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+
+_logger = logging.getLogger(__name__)
+
+
+class Notifier(object):
+    '''
+    A notification hub, used to wake up requests that wait for something to happen (e.g. long polling).
+
+    Notifications are addressed by key (such as a username). Each key has a sequence number that is incremented on
+    every notification, so that a waiter can detect notifications which have been sent between reading the current
+    state and starting to wait:
+
+        since = notifier.version(key)
+        ... check the current state ...
+        notifier.wait(key, since, timeout)
+
+    Waiting is always done in-process, while notifications are published through a backend, which determines who
+    receives them: the LocalBackend delivers them in the current process only, while the SqliteBackend delivers them to
+    every process on the host that uses the same file (e.g. pre-forked workers).
+    '''
+
+    def __init__(self, backend=None):
+        '''
+        :param backend: the backend used for publishing notifications (optional, a LocalBackend is used if not set)
+        '''
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._conditions = {}
+        self._backend = backend or LocalBackend()
+        self._backend.attach(self._deliver)
+
+    @property
+    def backend(self):
+        return self._backend
+
+    def version(self, key):
+        '''
+        :param key: notification key
+        :return: the current sequence number of the key
+        '''
+        # make sure that notifications are received by this process, from now on
+        self._backend.listen()
+
+        with self._lock:
+            return self._versions.get(key, 0)
+
+    def notify(self, key):
+        '''
+        Publishes a notification, waking up all of the waiters of the key.
+
+        :param key: notification key
+        '''
+        self._backend.publish(key)
+
+    def wait(self, key, since, timeout):
+        '''
+        Blocks until the key is notified, or the timeout expires.
+
+        :param key: notification key
+        :param since: sequence number of the key, as read by the waiter before checking the current state
+        :param timeout: maximal number of seconds to wait
+        :return: True if the key has been notified since the given sequence number, False if timed out
+        '''
+        deadline = time.time() + timeout
+
+        with self._lock:
+            # conditions are kept only while there are waiters on the key
+            condition, waiters = self._conditions.get(key, (None, 0))
+            condition = condition or threading.Condition(self._lock)
+            self._conditions[key] = (condition, waiters + 1)
+
+            try:
+                while self._versions.get(key, 0) == since:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+
+                    condition.wait(remaining)
+
+                return True
+
+            finally:
+                condition, waiters = self._conditions[key]
+                if waiters > 1:
+                    self._conditions[key] = (condition, waiters - 1)
+                else:
+                    del self._conditions[key]
+
+    def _deliver(self, key):
+        '''
+        Called by the backend whenever a notification is received by the current process.
+
+        :param key: notification key
+        '''
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+
+            if key in self._conditions:
+                self._conditions[key][0].notify_all()
+
+
+class NotifierBackend(object):
+    '''
+    Base class for notifier backends.
+
+    A backend publishes notifications, and delivers the notifications it receives to the notifier it is attached to.
+    '''
+
+    def __init__(self):
+        self._deliver = None
+
+    def attach(self, deliver):
+        '''
+        Attaches the backend to a notifier.
+
+        :param deliver: a function to call with the key of each received notification
+        '''
+        self._deliver = deliver
+
+    def listen(self):
+        '''
+        Makes sure that the backend receives notifications in the current process. Called before reading the state of
+        a key, prior to waiting for it.
+        '''
+        pass
+
+    def publish(self, key):
+        '''
+        Publishes a notification.
+
+        :param key: notification key
+        '''
+        raise NotImplementedError('Internal class: Please use one of the backend subclasses instead.')
+
+    def close(self):
+        '''
+        Releases the resources held by the backend.
+        '''
+        pass
+
+
+class LocalBackend(NotifierBackend):
+    '''
+    Delivers notifications within the current process only.
+    '''
+
+    def publish(self, key):
+        self._deliver(key)
+
+
+class SqliteBackend(NotifierBackend):
+    '''
+    Delivers notifications to all of the processes on the host that use the same sqlite file.
+
+    Published notifications are appended to a table, which is polled by a single background thread per process. The
+    thread is started lazily, the first time the process waits for a notification, so that it is safe to create the
+    backend before forking workers. Old notifications are pruned by publishers.
+    '''
+
+    def __init__(self, path, poll_interval=0.05, retention=60, prune_every=1000):
+        '''
+        :param path: path of the sqlite file, which is created if it does not exist
+        :param poll_interval: number of seconds between polls of the notifications table
+        :param retention: number of seconds notifications are kept before being pruned
+        :param prune_every: number of notifications published by a process between prunes
+        '''
+        super(SqliteBackend, self).__init__()
+        self._path = path
+        self._poll_interval = poll_interval
+        self._retention = retention
+        self._prune_every = prune_every
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._listener_pid = None
+        self._published = 0
+        self._closed = threading.Event()
+
+        connection = self._connect()
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS notifications ('
+                           'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                           'key TEXT NOT NULL, '
+                           'created_at REAL NOT NULL)')
+        connection.close()
+
+    def listen(self):
+        # the listener thread does not survive forks, so it is started per process
+        if self._listener_pid != os.getpid():
+            with self._lock:
+                if self._listener_pid != os.getpid():
+                    self._listener_pid = os.getpid()
+                    self._closed.clear()
+
+                    listener = threading.Thread(target=self._listen, args=(self._last_id(),))
+                    listener.daemon = True
+                    listener.start()
+
+    def publish(self, key):
+        connection = self._connection()
+
+        with connection:
+            connection.execute('INSERT INTO notifications (key, created_at) VALUES (?, ?)', (key, time.time()))
+
+        with self._lock:
+            self._published += 1
+            prune = self._published % self._prune_every == 0
+
+        if prune:
+            with connection:
+                connection.execute('DELETE FROM notifications WHERE created_at < ?', (time.time() - self._retention,))
+
+    def close(self):
+        self._closed.set()
+
+    def _listen(self, last_id):
+        '''
+        Polls the notifications table and delivers new notifications, until the backend is closed.
+
+        :param last_id: id of the last notification published before the listener has started
+        '''
+        connection = self._connect()
+
+        try:
+            while not self._closed.wait(self._poll_interval):
+                try:
+                    rows = connection.execute('SELECT id, key FROM notifications WHERE id > ? ORDER BY id',
+                                              (last_id,)).fetchall()
+                except sqlite3.Error:
+                    # e.g. the file is locked during a checkpoint. polling goes on with a new connection, and the
+                    # notifications that have been published meanwhile are delivered by the next poll
+                    _logger.exception('polling notifications failed')
+                    connection.close()
+                    connection = self._connect()
+                    continue
+
+                for notification_id, key in rows:
+                    last_id = notification_id
+                    self._deliver(key)
+
+        finally:
+            connection.close()
+
+            # a listener that has stopped for any reason is started again by the next `listen` of the process
+            with self._lock:
+                if self._listener_pid == os.getpid():
+                    self._listener_pid = None
+
+    def _last_id(self):
+        connection = self._connect()
+
+        try:
+            return connection.execute('SELECT COALESCE(MAX(id), 0) FROM notifications').fetchone()[0]
+        finally:
+            connection.close()
+
+    def _connection(self):
+        '''
+        :return: the sqlite connection of the current thread, which is opened on first use (sqlite connections cannot
+                 be shared by threads or forked processes)
+        '''
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.connection = self._connect()
+            self._local.pid = os.getpid()
+
+        return self._local.connection
+
+    def _connect(self):
+        connection = sqlite3.connect(self._path, timeout=10)
+        connection.execute('PRAGMA synchronous=OFF')
+        return connection
+
+
+def create_backend(url):
+    '''
+    Creates a notifier backend from a url.
+
+    :param url: either "local", or "sqlite:///<path>" for a backend shared by the processes on the host
+    '''
+    if url == 'local':
+        return LocalBackend()
+
+    if url.startswith('sqlite:///'):
+        return SqliteBackend(url[len('sqlite:///'):])
+
+    raise Exception('Unsupported notifier url: {0}'.format(url))
@@ -9,6 +9,9 @@ class _RequestParser(object):
     RequestParser is a declarative interface to describe the parameters expected by an endpoint handler.
     
     It is very similar in form to argparse.ArgumentParser().
+
+    Parsers are meant to be declared once (e.g. as class attributes of an endpoint) and used for parsing every request,
+    since argument declarations are compiled into a validator and a result type when added.
     
     This is an internal baseclass, and cannot be used outside.
     '''
@@ -19,7 +22,8 @@ class _RequestParser(object):
     source = 'request'
 
     def __init__(self):
-        self._arguments = {}
+        self._arguments = collections.OrderedDict()
+        self._compile()
 
     def add_argument(self, name, help='', type=object, required=False, default=None):
         '''
@@ -37,6 +41,7 @@ class _RequestParser(object):
 
         self._arguments[name] = {'help': help, 'type': type, 'required': required, 'default': default}
         self._validate_rule(name, self._arguments[name])
+        self._compile()
 
     def parse_args(self):
         '''
@@ -45,28 +50,40 @@ class _RequestParser(object):
         :return: an object whose fields match the expected arguments 
         '''
 
-        ParsedArguments = collections.namedtuple('ParsedArguments',
-                                                 [argname.replace('-', '_') for argname in self._arguments.keys()])
+        source = self._get_source()
 
         argument_values = []
-        for arg_name, arg_rule in self._arguments.iteritems():
-            arg_val = self._get_argument_value(arg_name)
+        for arg_name, arg_type, required, default, missing_message, type_message in self._rules:
+            arg_val = source.get(arg_name)
 
             if arg_val is None:
-                arg_val = arg_rule['default']
+                arg_val = default
 
-            if arg_val is None and arg_rule['required']:
-                raise server.exception.RestfulException(400, 'missing field "{0}" in {1}: {2}'.format(arg_name,
-                                                                                                      self.source,
-                                                                                                      arg_rule['help']))
+            if arg_val is None and required:
+                raise server.exception.RestfulException(400, missing_message)
 
-            if arg_val is not None and not isinstance(arg_val, arg_rule['type']):
-                raise server.exception.RestfulException(400, 'field "{0}": wrong type. expected: {1}'.format(arg_name,
-                                                                                                             arg_rule['type'].__name__))
+            if arg_val is not None and not isinstance(arg_val, arg_type):
+                raise server.exception.RestfulException(400, type_message)
 
             argument_values.append(arg_val)
 
-        return ParsedArguments(*argument_values)
+        return self._result_type(*argument_values)
+
+    def _compile(self):
+        '''
+        Precomputes the result type and the validation rules of the parser, so that parsing does as little as possible.
+        '''
+
+        self._result_type = collections.namedtuple('ParsedArguments',
+                                                   [argname.replace('-', '_') for argname in self._arguments.keys()])
+
+        self._rules = [(arg_name,
+                        arg_rule['type'],
+                        arg_rule['required'],
+                        arg_rule['default'],
+                        'missing field "{0}" in {1}: {2}'.format(arg_name, self.source, arg_rule['help']),
+                        'field "{0}": wrong type. expected: {1}'.format(arg_name, arg_rule['type'].__name__))
+                       for arg_name, arg_rule in self._arguments.iteritems()]
 
     def _validate_rule(self, argument_name, rule):
         '''
@@ -81,13 +98,12 @@ class _RequestParser(object):
         if rule['required'] and rule['default'] is not None:
             raise Exception('Invalid argument {0}: cannot be "required" and have default value.'.format(argument_name))
 
-    def _get_argument_value(self, name):
+    def _get_source(self):
         '''
-        When parsing arguments, this method provides an interface to get an argument's value from the request.
-        
-        Parsers implement this method according to the part of the request they refer to. 
+        When parsing arguments, this method provides the part of the request that holds the arguments' values.
         
-        :param name: name of the parameter to fetch
+        Parsers implement this method according to the part of the request they refer to. It is called once per
+        parse, and should return a mapping of argument names to values.
         '''
         raise NotImplementedError('Internal class: Please use one of the parser subclasses instead.')
 
@@ -99,11 +115,10 @@ class BodyParser(_RequestParser):
 
     source = 'body'
 
-    def _get_argument_value(self, name):
-        try:
-            return flask.request.get_json(force=True).get(name)
-        except:
-            return None
+    def _get_source(self):
+        # the body is decoded once per request, and shared by all of the parsers that use it
+        body = flask.request.get_json(force=True, silent=True)
+        return body if isinstance(body, dict) else {}
 
 
 class _TypelessRequestParser(_RequestParser):
@@ -127,11 +142,8 @@ class HeadersParser(_TypelessRequestParser):
 
     source = 'headers'
 
-    def _get_argument_value(self, name):
-        try:
-            return flask.request.headers.get(name)
-        except:
-            return None
+    def _get_source(self):
+        return flask.request.headers
 
 
 class QuerystringParser(_TypelessRequestParser):
@@ -141,8 +153,5 @@ class QuerystringParser(_TypelessRequestParser):
 
     source = 'querystring'
 
-    def _get_argument_value(self, name):
-        try:
-            return flask.request.args.get(name)
-        except:
-            return None
+    def _get_source(self):
+        return flask.request.args
@@ -0,0 +1,184 @@
+import os
+import time
+import errno
+import signal
+import socket
+import threading
+import traceback
+
+import werkzeug.wsgi
+import werkzeug.serving
+
+
+def serve(app, host, port, workers=1, shutdown_timeout=10, after_fork=None):
+    '''
+    Serves a wsgi app until it receives SIGTERM or SIGINT, handling requests on separate threads.
+
+    With more than one worker, the listening socket is opened once and shared by forked worker processes, each with
+    its own threads. Workers that exit unexpectedly are replaced.
+
+    On shutdown, new connections are no longer accepted, and in-flight requests are given `shutdown_timeout` seconds
+    to complete.
+
+    :param app: the wsgi app
+    :param host: listening address
+    :param port: listening port number
+    :param workers: number of worker processes, or 1 to serve from the current process
+    :param shutdown_timeout: seconds to wait for in-flight requests when shutting down
+    :param after_fork: a function called by each worker process once it has been forked (e.g. to reset db pools),
+                       with the index of the worker. a worker that replaces another gets its index.
+    '''
+    if workers <= 1:
+        _serve_worker(werkzeug.serving.make_server(host, port, _InFlight(app), threaded=True), shutdown_timeout)
+        return
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(128)
+
+    # workers race to accept each connection, so the losers must not block on it
+    listener.setblocking(0)
+
+    stopping = _install_stop_handlers()
+
+    # maps the pid of each worker to its index
+    children = {}
+
+    try:
+        while not stopping.is_set():
+            # fork missing workers (all of them on the first iteration)
+            for index in set(xrange(workers)) - set(children.itervalues()):
+                children[_fork_worker(app, host, listener, shutdown_timeout, after_fork, index)] = index
+
+            for pid in _reap(children):
+                del children[pid]
+
+            stopping.wait(0.5)
+
+    finally:
+        listener.close()
+        _stop_workers(set(children), shutdown_timeout)
+
+
+def _fork_worker(app, host, listener, shutdown_timeout, after_fork, index):
+    pid = os.fork()
+    if pid != 0:
+        return pid
+
+    # worker process, never returns to the caller
+    exit_code = 0
+
+    try:
+        if after_fork is not None:
+            after_fork(index)
+
+        server = werkzeug.serving.make_server(host, 0, _InFlight(app), threaded=True, fd=listener.fileno())
+        _serve_worker(server, shutdown_timeout)
+
+    except Exception:
+        traceback.print_exc()
+        exit_code = 1
+
+    finally:
+        os._exit(exit_code)
+
+
+def _serve_worker(server, shutdown_timeout):
+    stopping = _install_stop_handlers()
+
+    # the server runs on a separate thread, since it can only be stopped from another thread
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    while not stopping.is_set() and thread.is_alive():
+        stopping.wait(0.5)
+
+    # stop accepting connections, then let in-flight requests complete
+    server.shutdown()
+    thread.join()
+    server.app.wait_idle(shutdown_timeout)
+
+
+def _install_stop_handlers():
+    stopping = threading.Event()
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: stopping.set())
+
+    return stopping
+
+
+def _reap(children):
+    '''
+    :return: the pids of the children that have exited
+    '''
+    exited = set()
+
+    for pid in children:
+        try:
+            if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                exited.add(pid)
+        except OSError as err:
+            if err.errno == errno.ECHILD:
+                exited.add(pid)
+
+    return exited
+
+
+def _stop_workers(children, shutdown_timeout):
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    # give workers time to finish their in-flight requests, then kill the ones that did not exit
+    deadline = time.time() + shutdown_timeout + 1
+    while children and time.time() < deadline:
+        children -= _reap(children)
+        time.sleep(0.1)
+
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+
+
+class _InFlight(object):
+    '''
+    A wsgi middleware that counts the requests being handled, including responses that are still being streamed.
+    '''
+
+    def __init__(self, app):
+        self._app = app
+        self._count = 0
+        self._condition = threading.Condition()
+
+    def __call__(self, environ, start_response):
+        with self._condition:
+            self._count += 1
+
+        try:
+            return werkzeug.wsgi.ClosingIterator(self._app(environ, start_response), self._done)
+        except:
+            self._done()
+            raise
+
+    def wait_idle(self, timeout):
+        '''
+        Waits until no requests are being handled, or until the timeout elapses.
+        '''
+        deadline = time.time() + timeout
+
+        with self._condition:
+            while self._count > 0 and time.time() < deadline:
+                self._condition.wait(deadline - time.time())
+
+    def _done(self):
+        with self._condition:
+            self._count -= 1
+            self._condition.notify_all()
@@ -0,0 +1,119 @@
+import time
+import logging
+import threading
+
+
+class Scheduler(object):
+    '''
+    Runs periodic tasks (e.g. maintenance of the db) on a background thread.
+
+    Each task may return a dict of counts (e.g. the number of rows it has removed), which are accumulated in the
+    stats of the task.
+    '''
+
+    def __init__(self, logger=None):
+        self._logger = logger or logging.getLogger(__name__)
+        self._tasks = []
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def add(self, name, interval, task):
+        '''
+        :param name: name of the task, used for logging and stats
+        :param interval: seconds between consecutive runs of the task
+        :param task: a function that receives no arguments, and optionally returns a dict of counts
+        '''
+        self._tasks.append(_Task(name, interval, task))
+
+    def start(self):
+        '''
+        Starts running the tasks, each after its first interval has elapsed.
+        '''
+        if self._thread is not None or not self._tasks:
+            return
+
+        now = time.time()
+        for task in self._tasks:
+            task.next_run = now + task.interval
+
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._loop, name='scheduler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        '''
+        Stops running the tasks, waiting for a running one to complete.
+        '''
+        if self._thread is None:
+            return
+
+        self._stopping.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def run_pending(self):
+        '''
+        Runs the tasks that are due.
+
+        :return: seconds until the next task is due
+        '''
+        now = time.time()
+
+        for task in self._tasks:
+            if task.next_run <= now and not self._stopping.is_set():
+                self._run(task)
+                task.next_run = time.time() + task.interval
+
+        return max(0, min(task.next_run for task in self._tasks) - time.time())
+
+    def stats(self):
+        '''
+        :return: a dict of the stats of each task: number of runs and failures, time of last run and accumulated counts
+        '''
+        with self._lock:
+            return dict((task.name, {'runs': task.runs,
+                                     'failures': task.failures,
+                                     'last_run': task.last_run,
+                                     'counts': dict(task.counts)})
+                        for task in self._tasks)
+
+    def _loop(self):
+        while not self._stopping.is_set():
+            self._stopping.wait(self.run_pending())
+
+    def _run(self, task):
+        try:
+            counts = task.run() or {}
+        except Exception:
+            self._logger.exception('scheduled task "{0}" failed'.format(task.name))
+
+            with self._lock:
+                task.failures += 1
+                task.last_run = int(time.time())
+            return
+
+        with self._lock:
+            task.runs += 1
+            task.last_run = int(time.time())
+
+            for name, count in counts.iteritems():
+                task.counts[name] = task.counts.get(name, 0) + count
+
+        if any(counts.itervalues()):
+            self._logger.info('scheduled task "{0}": {1}'.format(
+                task.name, ', '.join('{0} {1}'.format(name, count) for name, count in sorted(counts.iteritems()))))
+
+
+class _Task(object):
+
+    def __init__(self, name, interval, run):
+        self.name = name
+        self.interval = interval
+        self.run = run
+        self.next_run = 0
+        self.runs = 0
+        self.failures = 0
+        self.last_run = None
+        self.counts = {}
@@ -0,0 +1,62 @@
+import sqlalchemy.orm
+import sqlalchemy.event
+
+
+def create_session_factory(engine):
+    '''
+    Creates a session factory that keeps track of whether its sessions have written anything, so that requests which
+    only read do not have to commit.
+
+    :param engine: the engine to bind sessions to
+    '''
+    factory = sqlalchemy.orm.sessionmaker(bind=engine)
+
+    sqlalchemy.event.listen(factory, 'before_flush', _check_writable)
+    sqlalchemy.event.listen(factory, 'after_flush', lambda session, flush_context: _set_written(session, True))
+    sqlalchemy.event.listen(factory, 'after_bulk_update', lambda context: _set_written(context.session, True))
+    sqlalchemy.event.listen(factory, 'after_bulk_delete', lambda context: _set_written(context.session, True))
+    sqlalchemy.event.listen(factory, 'after_commit', _committed)
+    sqlalchemy.event.listen(factory, 'after_rollback', lambda session: _set_written(session, False))
+
+    return factory
+
+
+def set_read_only(session):
+    '''
+    Marks a session as read only, so that flushing any changes through it fails.
+    '''
+    session.info['read_only'] = True
+
+
+def has_pending_writes(session):
+    '''
+    :return: whether the session has changes that have not been committed yet.
+             note that bulk inserts and core statements are not tracked, and should be committed explicitly.
+    '''
+    if session.info.get('read_only'):
+        return False
+
+    return bool(session.info.get('written') or session.new or session.dirty or session.deleted)
+
+
+def has_committed_writes(session):
+    '''
+    :return: whether the session has committed any changes since it was created
+    '''
+    return session.info.get('committed', False)
+
+
+def _committed(session):
+    if session.info.get('written'):
+        session.info['committed'] = True
+
+    _set_written(session, False)
+
+
+def _set_written(session, written):
+    session.info['written'] = written
+
+
+def _check_writable(session, flush_context, instances):
+    if session.info.get('read_only') and (session.new or session.dirty or session.deleted):
+        raise Exception('Cannot write through a read only session.')
@@ -1,22 +1,112 @@
 #!/usr/bin/env python
 import argparse
+import multiprocessing
 
 import server
 import resources.user
 import resources.message
+import resources.group
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', '--port', help='listening port number', type=int, default=3000)
     parser.add_argument('-db', '--database', help='url of database', default='sqlite:///www/db.sqlite')
+    parser.add_argument('--shard', help='url of a db to shard messages to (repeat for multiple shards)',
+                        action='append', dest='shards')
+    parser.add_argument('--replica', help='url of a read replica of the db (repeat for multiple replicas)',
+                        action='append', dest='replicas')
+    parser.add_argument('--sqlite-replica', help='path of a periodically refreshed copy of the db, to be used as a '
+                                                 'read replica for local testing')
+    parser.add_argument('--replica-interval', help='seconds between refreshes of the sqlite replica', type=float,
+                        default=1)
+    parser.add_argument('--read-your-writes', help='seconds during which users who wrote are not served by replicas',
+                        type=float, default=5)
+    parser.add_argument('--pool-size', help='number of db connections kept open', type=int)
+    parser.add_argument('--max-overflow', help='number of db connections opened beyond the pool size', type=int)
+    parser.add_argument('--pool-recycle', help='seconds after which db connections are reopened', type=int)
+    parser.add_argument('--pool-pre-ping', help='test db connections before using them', action='store_true')
+    parser.add_argument('--sqlite-profile', help='pragmas applied to sqlite connections',
+                        choices=sorted(server.SQLITE_PROFILES), default='durable')
+    parser.add_argument('--batch-writes', help='commit concurrently sent messages together', action='store_true')
+    parser.add_argument('--batch-delay', help='milliseconds a sent message waits for others to join its commit',
+                        type=float, default=5)
+    parser.add_argument('--batch-size', help='maximal number of messages committed together', type=int, default=200)
+    parser.add_argument('--max-message-age', help='seconds after which undeleted messages expire', type=int)
+    parser.add_argument('--max-queue', help='maximal number of undeleted messages per recipient', type=int)
+    parser.add_argument('--retention-interval', help='seconds between removals of expired messages and unused payloads',
+                        type=int, default=60)
+    parser.add_argument('--maintenance-interval', help='seconds between db vacuums and analyzes (0 to disable)',
+                        type=int, default=3600)
+    parser.add_argument('--user-rate', help='requests per second allowed per user and worker', type=float)
+    parser.add_argument('--address-rate', help='requests per second allowed per client address and worker', type=float)
+    parser.add_argument('--rate-burst', help='number of requests a user or client address may make at once', type=int)
+    parser.add_argument('--max-in-flight', help='number of requests handled at once per worker, beyond which requests '
+                                                'are rejected', type=int)
+    parser.add_argument('--metrics', help='expose metrics of the server on /metrics, in the prometheus text format',
+                        action='store_true')
+    parser.add_argument('-s', '--secret', help='secret for signing session tokens (random if not set)')
+    parser.add_argument('-n', '--notifier', help='url of notification backend, "local" or "sqlite:///<path>"',
+                        default='local')
+    parser.add_argument('-j', '--json', help='json backend, "ujson", "simplejson", "stdlib" or "auto"',
+                        default='auto')
+    parser.add_argument('-m', '--mode', help='"threaded" or "prefork" for production, or "development"',
+                        choices=['threaded', 'prefork', 'development'], default='threaded')
+    parser.add_argument('-w', '--workers', help='number of worker processes in prefork mode', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--shutdown-timeout', help='seconds to wait for in-flight requests when stopping', type=int,
+                        default=10)
+    parser.add_argument('--migrate-only', help='apply pending db migrations and exit', action='store_true')
     args = parser.parse_args()
 
     app = server.Server(__name__)
 
-    app.use_db(args.database)
+    app.use_db(args.database,
+               pool_size=args.pool_size,
+               max_overflow=args.max_overflow,
+               pool_recycle=args.pool_recycle,
+               pool_pre_ping=args.pool_pre_ping,
+               sqlite_profile=args.sqlite_profile,
+               shards=args.shards,
+               replicas=args.replicas,
+               read_your_writes=args.read_your_writes)
+
+    if args.sqlite_replica is not None:
+        app.use_sqlite_replica(args.sqlite_replica, args.replica_interval)
+
+    if args.batch_writes:
+        app.use_write_batching(args.batch_delay / 1000.0, args.batch_size)
+
+    if args.user_rate is not None or args.address_rate is not None:
+        app.use_rate_limits(args.user_rate, args.address_rate, args.rate_burst,
+                            identify=resources.user.authentication.identify)
+
+    if args.max_in_flight is not None:
+        app.use_max_in_flight(args.max_in_flight)
+
+    if args.metrics:
+        app.use_metrics()
+
+    app.use_notifier(args.notifier)
+    app.use_json_encoder(args.json)
+
+    if args.secret is not None:
+        app.use_secret(args.secret)
 
     app.use_resource(resources.user)
     app.use_resource(resources.message)
+    app.use_resource(resources.group)
+
+    # runs even without a policy, in order to sweep shared payloads that outlived their messages
+    retention = resources.message.retention.Retention(args.max_message_age, args.max_queue)
+    app.schedule('message retention', args.retention_interval, retention.run, dbs='shards')
+
+    if args.maintenance_interval > 0:
+        app.use_maintenance(args.maintenance_interval)
 
-    app.run(args.port)
+    if args.migrate_only:
+        app.migrate()
+    elif args.mode == 'development':
+        app.run(args.port)
+    else:
+        app.serve(args.port, args.workers if args.mode == 'prefork' else 1, args.shutdown_timeout)
@@ -1,14 +1,31 @@
 import unittest
 import os
+import base64
+import hashlib
 import os.path
 import collections
 import shutil
 import time
+import sqlite3
 import subprocess
+import threading
 import requests
 import tinylog
 
 
+def server_options(options):
+    '''
+    Sets extra command line options of the server that is started for a test.
+
+    :param options: the options, where "{assets}" is replaced with the assets path of the test
+    '''
+    def decorator(test):
+        test.server_options = options
+        return test
+
+    return decorator
+
+
 class SanityTestCase(unittest.TestCase):
     '''
     This a sanity check for the server.
@@ -71,9 +88,13 @@ class SanityTestCase(unittest.TestCase):
         self._logger.debug('Starting server process')
 
         db_file = os.path.join(SanityTestCase.assets_path, 'db.sqlite')
+        options = getattr(getattr(self, self._testMethodName), 'server_options', '')
 
-        server_instance = subprocess.Popen('./start.py -p {0} -db "sqlite:///{1}"'.format(SanityTestCase.server_port,
-                                                                                          db_file),
+        # the shell is replaced by the server, so that the server itself is stopped on tear down
+        server_instance = subprocess.Popen('exec ./start.py -p {0} -db "sqlite:///{1}" {2}'.format(
+                                               SanityTestCase.server_port,
+                                               db_file,
+                                               options.format(assets=SanityTestCase.assets_path)),
                                            shell=True,
                                            cwd=SanityTestCase.executable_path,
                                            stdout=subprocess.PIPE,
@@ -81,12 +102,19 @@ class SanityTestCase(unittest.TestCase):
 
         return server_instance
 
-    def _kill_server_instance(self):
+    def _kill_server_instance(self, timeout=20):
         '''
-        Kills server process.
+        Stops server process, so that it stops its workers as well (if it has any). Kills it if it does not stop in time.
         '''
         self._logger.debug('Killing server process')
-        self._server_instance.kill()
+        self._server_instance.terminate()
+
+        while self._server_instance.poll() is None and timeout > 0:
+            timeout -= 1
+            time.sleep(0.5)
+
+        if self._server_instance.poll() is None:
+            self._server_instance.kill()
 
     def _await_server_up(self, timeout=20):
         '''
@@ -263,6 +291,28 @@ class SanityTestCase(unittest.TestCase):
                               {'username': 'roysom', 'info': 'i am bea, i like tea'},
                               ignore_fields=('id', 'private_key', 'public_key'))
 
+    def test_change_password(self):
+        '''
+        Tests that changing the password replaces the cached credentials of the user.
+        '''
+        user = self._register_user('roysom', 'bananas')
+
+        self._logger.info('Authenticating with the current password, so that it is cached')
+        user.send('get', '/users/me')
+        login = user.send('post', '/users/login')
+
+        self._logger.info('Attempting to change the password with a session token, expecting it to fail')
+        self._send_request('post', '/users/me', headers={'authorization': 'Bearer {0}'.format(login['token'])},
+                           body={'password': 'apples'}, expected_status=401)
+        user.send('get', '/users/me')
+
+        self._logger.info('Changing the password')
+        user.send('post', '/users/me', body={'password': 'apples'})
+
+        self._logger.info('Making sure that only the new password is accepted')
+        user.send('get', '/users/me', expected_status=401)
+        self._send_request_as('roysom', 'apples')('get', '/users/me')
+
     def test_user_search(self):
         '''
         Tests user search.
@@ -275,6 +325,15 @@ class SanityTestCase(unittest.TestCase):
         self._assert_response(res, {'username': 'avivbh',
                                     'public_key': 'public_key'})
 
+        self._logger.info('Testing that users are found once registered, after having been looked up')
+        users['roysom'].send('get', '/users/friends', params={'username': 'rubens'}, expected_status=404)
+        users['roysom'].send('post', '/messages', body={'recipient': 'rubens', 'contents': 'foo'}, expected_status=404)
+
+        self._register_user('rubens', 'nectarine')
+        res = users['roysom'].send('get', '/users/friends', params={'username': 'rubens'})
+        self._assert_response(res, {'username': 'rubens', 'public_key': 'public_key'})
+        users['roysom'].send('post', '/messages', body={'recipient': 'rubens', 'contents': 'foo'})
+
     def test_send_message(self):
         '''
         Test sending messages between users, tenancy and deletion policy.
@@ -333,6 +392,13 @@ class SanityTestCase(unittest.TestCase):
         self._logger.info('Testing request without credentials')
         self._send_request('get', '/messages', expected_status=401)
 
+        self._logger.info('Testing methods that are not implemented, which have no json body')
+        for method in ['head', 'options', 'put']:
+            response = requests.request(method, 'http://localhost:{0}/messages'.format(SanityTestCase.server_port),
+                                        headers={'x-user-name': 'inspector_gadget', 'x-user-token': 'foobarfoobar'},
+                                        params={'wait': 10})
+            self.assertEqual(response.status_code, 405)
+
         self._logger.info('Testing request with bad credentials')
         self._send_request_as('inspector_gadget', 'not right')('get', '/messages', expected_status=401)
 
@@ -350,3 +416,560 @@ class SanityTestCase(unittest.TestCase):
         for endpoint, methods in endpoints.iteritems():
             for method, expected_status in methods.iteritems():
                 self._send_request(method, endpoint, expected_status=expected_status)
+
+        self._logger.info('Testing methods that are not supported by the endpoints')
+        self._send_request('put', '/messages', expected_status=405)
+        self._send_request('delete', '/users/me', expected_status=405)
+        self._send_request('get', '/no/such/endpoint', expected_status=404)
+
+    def test_session_token(self):
+        '''
+        Tests logging in for a session token, and authenticating with it.
+        '''
+        self._register_preset_users()
+
+        self._logger.info('Logging in with credentials')
+        login = self._send_request_as('roysom', 'bananas')('post', '/users/login')
+        self.assertEqual(login['token_type'], 'bearer')
+
+        self._logger.info('Testing requests with session token')
+        bearer = {'authorization': 'Bearer {0}'.format(login['token'])}
+        me = self._send_request('get', '/users/me', headers=bearer)
+        self.assertEqual(me['username'], 'roysom')
+        self._send_request('post', '/messages', headers=bearer, body={'recipient': 'avivbh', 'contents': 'foo'})
+
+        self._logger.info('Testing requests with tampered and bad session tokens')
+        tampered = {'authorization': 'Bearer {0}x'.format(login['token'])}
+        self._send_request('get', '/messages', headers=tampered, expected_status=401)
+        self._send_request('get', '/messages', headers={'authorization': 'Bearer foo'}, expected_status=401)
+
+        self._logger.info('Testing that session tokens cannot be renewed without the password')
+        self._send_request('post', '/users/login', headers=bearer, expected_status=401)
+
+        self._logger.info('Testing login with bad credentials')
+        self._send_request_as('roysom', 'apples')('post', '/users/login', expected_status=401)
+
+    def test_migrate_baseline_db(self):
+        '''
+        Tests that a db which was created by the first version of the server is migrated, and keeps its data.
+        '''
+        self._logger.info('Restarting the server with a db of the first version')
+        self._kill_server_instance()
+
+        db_file = os.path.join(SanityTestCase.assets_path, 'db.sqlite')
+        for path in [db_file, '{0}-wal'.format(db_file), '{0}-shm'.format(db_file)]:
+            if os.path.exists(path):
+                os.remove(path)
+
+        db = sqlite3.connect(db_file)
+        db.execute('CREATE TABLE messages (id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, from_user VARCHAR(32), '
+                   'to_user VARCHAR(32), contents VARCHAR(4096), sent_at INTEGER)')
+        db.execute('CREATE TABLE users (id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, username VARCHAR(32), '
+                   'password VARCHAR(44), salt VARCHAR(44), private_key VARCHAR(4096), public_key VARCHAR(4096), '
+                   'info VARCHAR(4096), UNIQUE (username))')
+
+        for username, password in [('roysom', 'bananas'), ('avivbh', 'galil')]:
+            salt = base64.b64encode(os.urandom(16))
+            hashed = base64.b64encode(hashlib.sha256('{0}{1}'.format(password, salt)).digest())
+            db.execute('INSERT INTO users (username, password, salt, private_key, public_key, info) '
+                       'VALUES (?, ?, ?, ?, ?, ?)', (username, hashed, salt, 'private_key', 'public_key', ''))
+
+        db.execute('INSERT INTO messages (from_user, to_user, contents, sent_at) VALUES (?, ?, ?, ?)',
+                   ('roysom', 'avivbh', 'foo', int(time.time())))
+        db.commit()
+        db.close()
+
+        self._server_instance = self._create_server_instance()
+        self._await_server_up()
+
+        self._logger.info('Making sure that the migrations have been applied')
+        db = sqlite3.connect(db_file)
+        migrations = set(db.execute('SELECT namespace, version FROM schema_migrations').fetchall())
+        self.assertEqual(migrations, set([('resources.user', 1), ('resources.user', 2), ('resources.message', 1),
+                                          ('resources.message', 2), ('resources.message', 3)]))
+        indexes = set(name for name, in db.execute("SELECT name FROM sqlite_master WHERE type = 'index'"))
+        self.assertTrue(indexes.issuperset(['ix_users_id_version', 'ix_messages_to_user_sent_at',
+                                            'ix_messages_to_user_id', 'ix_messages_payload_id']))
+        db.close()
+
+        self._logger.info('Making sure that existing users and messages are still served')
+        send_as_roysom = self._send_request_as('roysom', 'bananas')
+        send_as_avivbh = self._send_request_as('avivbh', 'galil')
+
+        messages = send_as_avivbh('get', '/messages', params={'after_id': 0})['messages']
+        self.assertEqual([message['contents'] for message in messages], ['foo'])
+
+        response = send_as_roysom('post', '/users/me', body={'info': 'i am bea, i like tea'})
+        self.assertEqual(response['info'], 'i am bea, i like tea')
+
+        self._logger.info('Sending messages through the migrated db')
+        group = send_as_roysom('post', '/groups', body={'name': 'friends', 'members': ['avivbh']})
+        send_as_roysom('post', '/groups/messages', body={'group': group['id'], 'contents': 'bar'})
+        send_as_roysom('post', '/messages', body={'recipient': 'avivbh', 'contents': 'baz'})
+
+        messages = send_as_avivbh('get', '/messages', params={'after_id': 0})['messages']
+        self.assertEqual([message['contents'] for message in messages], ['foo', 'bar', 'baz'])
+
+    def test_message_sync(self):
+        '''
+        Tests incremental message sync using the `after_id` cursor.
+        '''
+        users = self._register_preset_users()
+
+        self._logger.info('Sending messages from roysom to avivbh')
+        for contents in ['foo', 'bar', 'baz']:
+            users['roysom'].send('post', '/messages', body={'recipient': 'avivbh', 'contents': contents})
+
+        self._logger.info('Syncing messages page by page')
+        page = users['avivbh'].send('get', '/messages', params={'after_id': 0, 'limit': 2})
+        self.assertEqual([message['contents'] for message in page['messages']], ['foo', 'bar'])
+        self.assertTrue(page['has_more'])
+
+        page = users['avivbh'].send('get', '/messages', params={'after_id': page['next_cursor'], 'limit': 2})
+        self.assertEqual([message['contents'] for message in page['messages']], ['baz'])
+        self.assertFalse(page['has_more'])
+
+        self._logger.info('Making sure that nothing is returned once synced')
+        cursor = page['next_cursor']
+        page = users['avivbh'].send('get', '/messages', params={'after_id': cursor})
+        self.assertEqual(page['messages'], [])
+        self.assertEqual(page['next_cursor'], cursor)
+
+        self._logger.info('Testing that the newest messages have no cursor')
+        page = users['avivbh'].send('get', '/messages', params={'limit': 2})
+        self.assertEqual([message['contents'] for message in page['messages']], ['baz', 'bar'])
+        self.assertTrue(page['has_more'])
+        self.assertNotIn('next_cursor', page)
+
+        page = users['avivbh'].send('get', '/messages', params={'limit': 3})
+        self.assertEqual(len(page['messages']), 3)
+        self.assertFalse(page['has_more'])
+
+        self._logger.info('Testing bad cursor and page size')
+        users['avivbh'].send('get', '/messages', params={'after_id': 'foo'}, expected_status=400)
+        users['avivbh'].send('get', '/messages', params={'limit': 0}, expected_status=400)
+
+    def test_long_polling(self):
+        '''
+        Tests waiting for new messages with long polling.
+        '''
+        users = self._register_preset_users()
+
+        self._logger.info('Waiting for messages when there are none')
+        start_time = time.time()
+        page = users['avivbh'].send('get', '/messages', params={'after_id': 0, 'wait': 1})
+        self.assertEqual(page['messages'], [])
+        self.assertGreaterEqual(time.time() - start_time, 1)
+
+        self._logger.info('Waiting for a message that is sent while waiting')
+        sender = threading.Timer(1, users['roysom'].send, ['post', '/messages'],
+                                 {'body': {'recipient': 'avivbh', 'contents': 'foo'}})
+        sender.start()
+
+        start_time = time.time()
+        page = users['avivbh'].send('get', '/messages', params={'after_id': 0, 'wait': 10})
+        sender.join()
+
+        self.assertEqual([message['contents'] for message in page['messages']], ['foo'])
+        self.assertLess(time.time() - start_time, 10)
+
+        self._logger.info('Testing bad wait time')
+        users['avivbh'].send('get', '/messages', params={'wait': 'foo'}, expected_status=400)
+
+    @server_options('--sqlite-replica {assets}/replica.sqlite --replica-interval 60 --read-your-writes 0')
+    def test_lagging_replica(self):
+        '''
+        Tests that new messages and users are observed, even while the read replica is lagging behind.
+        '''
+        self._register_preset_users()
+
+        # session tokens are verified without a db, so that the replica (which has no users yet) is only queried for
+        # messages
+        login = self._send_request_as('avivbh', 'galil')('post', '/users/login')
+        bearer = {'authorization': 'Bearer {0}'.format(login['token'])}
+
+        self._logger.info('Waiting for a message that is sent while waiting')
+        sender = threading.Timer(1, self._send_request_as('roysom', 'bananas'), ['post', '/messages'],
+                                 {'body': {'recipient': 'avivbh', 'contents': 'foo'}})
+        sender.start()
+
+        page = self._send_request('get', '/messages', headers=bearer, params={'after_id': 0, 'wait': 10})
+        sender.join()
+
+        self.assertEqual([message['contents'] for message in page['messages']], ['foo'])
+        self.assertEqual(page['next_cursor'], page['messages'][0]['id'])
+
+        self._logger.info('Looking up a user who has just registered')
+        self._register_user('rubens', 'nectarine')
+        res = self._send_request('get', '/users/friends', headers=bearer, params={'username': 'rubens'})
+        self._assert_response(res, {'username': 'rubens', 'public_key': 'public_key'})
+
+        self._logger.info('Authenticating a user who has just registered by their password')
+        send_as_rubens = self._send_request_as('rubens', 'nectarine')
+        send_as_rubens('get', '/messages')
+        res = send_as_rubens('get', '/users/me')
+        self._assert_response(res, {'username': 'rubens', 'public_key': 'public_key', 'private_key': 'private_key',
+                                    'info': ''})
+        res = send_as_rubens('post', '/users/friends/batch', body={'usernames': ['rubens', 'avivbh']})
+        self.assertEqual([user['username'] for user in res['users']], ['rubens', 'avivbh'])
+        self.assertEqual(res['missing'], [])
+
+    def test_send_message_batch(self):
+        '''
+        Tests sending multiple messages in a single request, with partial failures.
+        '''
+        users = self._register_preset_users()
+
+        self._logger.info('Sending a batch of messages from roysom')
+        batch = [{'recipient': 'avivbh', 'contents': 'foo'},
+                 {'recipient': 'banuni', 'contents': 'bar'},
+                 {'recipient': 'nobody', 'contents': 'baz'},
+                 {'recipient': 'roysom', 'contents': 'qux'},
+                 {'recipient': 'avivbh'}]
+        response = users['roysom'].send('post', '/messages/batch', body={'messages': batch})
+
+        self.assertEqual(response['sent'], 2)
+        self.assertEqual(response['failed'], 3)
+        self.assertEqual([result['status'] for result in response['results']], [201, 201, 404, 400, 400])
+        self.assertEqual(['id' in result for result in response['results']], [True, True, False, False, False])
+
+        self._logger.info('Making sure that only the valid messages arrived, with the ids they were sent with')
+        aviv_messages = users['avivbh'].send('get', 'messages')
+        self.assertEqual([(message['id'], message['contents']) for message in aviv_messages['messages']],
+                         [(response['results'][0]['id'], 'foo')])
+        nuni_messages = users['banuni'].send('get', 'messages')
+        self.assertEqual([(message['id'], message['contents']) for message in nuni_messages['messages']],
+                         [(response['results'][1]['id'], 'bar')])
+
+        self._logger.info('Testing empty and malformed batches')
+        users['roysom'].send('post', '/messages/batch', body={'messages': []}, expected_status=400)
+        users['roysom'].send('post', '/messages/batch', body={'messages': 'foo'}, expected_status=400)
+
+    @server_options('--batch-writes --batch-delay 20')
+    def test_batched_writes(self):
+        '''
+        Tests that concurrently sent messages are committed together, and are each delivered exactly once.
+        '''
+        users = self._register_preset_users()
+
+        self._logger.info('Sending messages concurrently from roysom and banuni')
+        contents = ['{0}-{1}'.format(sender, index) for sender in ['roysom', 'banuni'] for index in range(20)]
+        responses = {}
+
+        def send(contents):
+            sender = contents.split('-')[0]
+            responses[contents] = users[sender].send('post', '/messages',
+                                                     body={'recipient': 'avivbh', 'contents': contents})
+
+        senders = [threading.Thread(target=send, args=[message_contents]) for message_contents in contents]
+        for sender in senders:
+            sender.start()
+        for sender in senders:
+            sender.join()
+
+        self.assertEqual(sorted(responses), sorted(contents))
+        self.assertEqual(len(set(response['id'] for response in responses.values())), len(contents))
+
+        self._logger.info('Making sure that every message arrived exactly once')
+        page = users['avivbh'].send('get', '/messages', params={'after_id': 0})
+        self.assertEqual(sorted(message['contents'] for message in page['messages']), sorted(contents))
+        self.assertEqual(sorted(message['id'] for message in page['messages']),
+                         sorted(response['id'] for response in responses.values()))
+
+    @server_options('--mode prefork --workers 2 --notifier sqlite:///{assets}/notifications.sqlite')
+    def test_prefork_workers(self):
+        '''
+        Tests that long polling requests are woken up by messages that are sent through other worker processes.
+        '''
+        users = self._register_preset_users()
+        recipients = ['avivbh', 'banuni', 'rubens', 'outsider', 'nectarine', 'galil']
+        for username in recipients[2:]:
+            users[username] = self._register_user(username, 'bananas')
+
+        # workers race to accept each request, so that some of the messages are sent through another worker than the
+        # one their recipient waits on
+        self._logger.info('Waiting for messages on both workers, while they are being sent')
+        pages = {}
+
+        def poll(username):
+            pages[username] = users[username].send('get', '/messages', params={'after_id': 0, 'wait': 10})
+
+        pollers = [threading.Thread(target=poll, args=[username]) for username in recipients]
+        for poller in pollers:
+            poller.start()
+
+        time.sleep(1)
+        start_time = time.time()
+        for username in recipients:
+            users['roysom'].send('post', '/messages', body={'recipient': username, 'contents': username})
+
+        for poller in pollers:
+            poller.join()
+
+        self.assertLess(time.time() - start_time, 5)
+        for username in recipients:
+            self.assertEqual([message['contents'] for message in pages[username]['messages']], [username])
+
+    @server_options('--shard sqlite:///{assets}/shard0.sqlite --shard sqlite:///{assets}/shard1.sqlite '
+                    '--shard sqlite:///{assets}/shard2.sqlite')
+    def test_sharded_messages(self):
+        '''
+        Tests sending messages to recipients whose messages are stored on different shards.
+        '''
+        users = self._register_preset_users()
+
+        self._logger.info('Sending a batch and a group message to recipients on different shards')
+        batch = [{'recipient': 'avivbh', 'contents': 'foo'}, {'recipient': 'banuni', 'contents': 'bar'}]
+        response = users['roysom'].send('post', '/messages/batch', body={'messages': batch})
+        self.assertEqual(response['sent'], 2)
+
+        group = users['roysom'].send('post', '/groups', body={'name': 'friends', 'members': ['avivbh', 'banuni']})
+        response = users['roysom'].send('post', '/groups/messages', body={'group': group['id'], 'contents': 'baz'})
+        self.assertEqual(response['recipients'], 2)
+        self.assertEqual(response['undelivered'], [])
+
+        self._logger.info('Making sure that each recipient got their messages')
+        for username, contents in [('avivbh', 'foo'), ('banuni', 'bar')]:
+            messages = users[username].send('get', '/messages', params={'after_id': 0})['messages']
+            self.assertEqual([message['contents'] for message in messages], [contents, 'baz'])
+
+    def test_group_messages(self):
+        '''
+        Tests creating groups and sending messages to them.
+        '''
+        users = self._register_preset_users()
+
+        self._logger.info('Creating a group')
+        group = users['roysom'].send('post', '/groups', body={'name': 'friends', 'members': ['avivbh', 'banuni']})
+        self._assert_response(group, {'name': 'friends', 'owner': 'roysom', 'members': ['avivbh', 'banuni', 'roysom']})
+
+        self._logger.info('Attempting to create a group with nonexistent members')
+        users['roysom'].send('post', '/groups', body={'name': 'foes', 'members': ['nobody']}, expected_status=404)
+
+        self._logger.info('Listing the groups of a member')
+        groups = users['banuni'].send('get', '/groups')
+        self.assertEqual([g['id'] for g in groups['groups']], [group['id']])
+
+        self._logger.info('Sending a message to the group')
+        response = users['avivbh'].send('post', '/groups/messages', body={'group': group['id'], 'contents': 'foo'})
+        self.assertEqual(response['recipients'], 2)
+
+        self._logger.info('Making sure that all members but the sender got the message')
+        for username in ['roysom', 'banuni']:
+            messages = users[username].send('get', '/messages')
+            self.assertEqual(len(messages['messages']), 1)
+            self._assert_response(messages['messages'][0],
+                                  {'contents': 'foo', 'from_user': 'avivbh', 'to_user': username,
+                                   'group_id': group['id']},
+                                  ignore_fields=('id', 'sent_at'))
+
+        self.assertEqual(users['avivbh'].send('get', '/messages')['messages'], [])
+
+        self._logger.info('Making sure that the contents are removed along with the last message that points at them')
+        db = sqlite3.connect(os.path.join(SanityTestCase.assets_path, 'db.sqlite'))
+        ack_id = users['roysom'].send('get', '/messages')['messages'][0]['id']
+        users['roysom'].send('post', '/messages/ack', body={'ids': [ack_id]})
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM payloads').fetchone()[0], 1)
+
+        users['banuni'].send('delete', '/messages', params={'until': int(time.time()) + 1})
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM payloads').fetchone()[0], 0)
+        db.close()
+
+        self._logger.info('Attempting to send a message to a foreign group')
+        self._register_user('outsider', 'foobar').send('post', '/groups/messages',
+                                                       body={'group': group['id'], 'contents': 'bar'},
+                                                       expected_status=404)
+
+    @server_options('--max-queue 2 --max-message-age 5 --retention-interval 1')
+    def test_message_retention(self):
+        '''
+        Tests that undeleted messages are trimmed to the queue cap and expired, along with the contents of groups.
+        '''
+        users = self._register_preset_users()
+        db = sqlite3.connect(os.path.join(SanityTestCase.assets_path, 'db.sqlite'))
+
+        self._logger.info('Sending a group message, and more messages to avivbh than the queue cap')
+        group = users['roysom'].send('post', '/groups', body={'name': 'friends', 'members': ['avivbh', 'banuni']})
+        users['avivbh'].send('post', '/groups/messages', body={'group': group['id'], 'contents': 'foo'})
+        for contents in ['bar', 'baz', 'qux', 'quux']:
+            users['roysom'].send('post', '/messages', body={'recipient': 'avivbh', 'contents': contents})
+
+        self._logger.info('Making sure that only the newest messages of avivbh are kept')
+        time.sleep(2.5)
+        messages = users['avivbh'].send('get', '/messages', params={'after_id': 0})['messages']
+        self.assertEqual([message['contents'] for message in messages], ['qux', 'quux'])
+        for username in ['roysom', 'banuni']:
+            messages = users[username].send('get', '/messages', params={'after_id': 0})['messages']
+            self.assertEqual([message['contents'] for message in messages], ['foo'])
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM payloads').fetchone()[0], 1)
+
+        self._logger.info('Making sure that old messages expire, along with the contents of the group message')
+        time.sleep(6)
+        users['roysom'].send('post', '/messages', body={'recipient': 'avivbh', 'contents': 'corge'})
+        time.sleep(1.5)
+
+        messages = users['avivbh'].send('get', '/messages', params={'after_id': 0})['messages']
+        self.assertEqual([message['contents'] for message in messages], ['corge'])
+        for username in ['roysom', 'banuni']:
+            self.assertEqual(users[username].send('get', '/messages', params={'after_id': 0})['messages'], [])
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM payloads').fetchone()[0], 0)
+        db.close()
+
+    def test_acknowledge_messages(self):
+        '''
+        Tests deleting delivered messages by id.
+        '''
+        users = self._register_preset_users()
+
+        self._logger.info('Sending messages to avivbh')
+        for contents in ['foo', 'bar', 'baz', 'qux']:
+            users['roysom'].send('post', '/messages', body={'recipient': 'avivbh', 'contents': contents})
+        users['avivbh'].send('post', '/messages', body={'recipient': 'banuni', 'contents': 'foo'})
+
+        messages = users['avivbh'].send('get', '/messages', params={'after_id': 0})['messages']
+        ids = [message['id'] for message in messages]
+        nuni_ids = [message['id'] for message in users['banuni'].send('get', '/messages')['messages']]
+
+        self._logger.info('Acknowledging messages by ids and ranges, including a message of someone else')
+        response = users['avivbh'].send('post', '/messages/ack', body={'ids': [ids[0]] + nuni_ids,
+                                                                        'ranges': [[ids[2], ids[3]]]})
+        self.assertEqual(response['deleted'], 3)
+
+        self._logger.info('Making sure that only the acknowledged messages were deleted')
+        messages = users['avivbh'].send('get', '/messages')['messages']
+        self.assertEqual([message['id'] for message in messages], [ids[1]])
+        self.assertEqual(len(users['banuni'].send('get', '/messages')['messages']), 1)
+
+        self._logger.info('Testing empty and malformed acknowledgements')
+        users['avivbh'].send('post', '/messages/ack', body={}, expected_status=400)
+        users['avivbh'].send('post', '/messages/ack', body={'ids': ['foo']}, expected_status=400)
+        users['avivbh'].send('post', '/messages/ack', body={'ranges': [[1]]}, expected_status=400)
+
+    def test_conditional_get(self):
+        '''
+        Tests revalidating fetched users and profiles by their entity tags.
+        '''
+        users = self._register_preset_users()
+        url = 'http://localhost:{0}{1}'.format(SanityTestCase.server_port, '{0}')
+        credentials = {'x-user-name': 'roysom', 'x-user-token': 'bananas'}
+
+        self._logger.info('Testing that an unmodified user is not sent again')
+        response = requests.get(url.format('/users/friends'), params={'username': 'avivbh'}, headers=credentials)
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+
+        headers = dict(credentials, **{'If-None-Match': etag})
+        response = requests.get(url.format('/users/friends'), params={'username': 'avivbh'}, headers=headers)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+        self.assertEqual(response.headers['ETag'], etag)
+
+        self._logger.info('Testing that the profile is sent again once it has been modified')
+        response = requests.get(url.format('/users/me'), headers=credentials)
+        headers = dict(credentials, **{'If-None-Match': response.headers['ETag']})
+        self.assertEqual(requests.get(url.format('/users/me'), headers=headers).status_code, 304)
+
+        users['roysom'].send('post', '/users/me', body={'info': 'new info'})
+
+        response = requests.get(url.format('/users/me'), headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['info'], 'new info')
+        self.assertNotEqual(response.headers['ETag'], headers['If-None-Match'])
+
+    def test_user_search_batch(self):
+        '''
+        Tests looking up multiple users at once.
+        '''
+        users = self._register_preset_users()
+
+        self._logger.info('Testing batch search endpoint')
+        res = users['roysom'].send('post', '/users/friends/batch', body={'usernames': ['banuni', 'nobody', 'avivbh',
+                                                                                      'banuni']})
+
+        self.assertEqual([user['username'] for user in res['users']], ['banuni', 'avivbh'])
+        self._assert_response(res['users'][1], {'username': 'avivbh', 'public_key': 'public_key'})
+        self.assertEqual(res['missing'], ['nobody'])
+
+        self._logger.info('Testing empty and oversized batches')
+        users['roysom'].send('post', '/users/friends/batch', body={'usernames': []}, expected_status=400)
+        users['roysom'].send('post', '/users/friends/batch', body={'usernames': ['foo'] * 501}, expected_status=400)
+
+    @server_options('--user-rate 0.2 --rate-burst 3')
+    def test_rate_limits(self):
+        '''
+        Tests that users who exceed their rate limit are rejected, without affecting other users.
+        '''
+        users = self._register_preset_users()
+        url = 'http://localhost:{0}/users/me'.format(SanityTestCase.server_port)
+
+        self._logger.info('Testing that requests of users who merely claim to be roysom are not counted')
+        for _ in xrange(5):
+            requests.get(url, headers={'x-user-name': 'roysom', 'x-user-token': 'apples'})
+
+        self._logger.info('Exceeding the rate limit of roysom')
+        # the first request verifies the password against the db, and is not counted since roysom is not yet verified
+        for _ in xrange(4):
+            users['roysom'].send('get', '/users/me')
+
+        response = requests.get(url, headers={'x-user-name': 'roysom', 'x-user-token': 'bananas'})
+        self.assertEqual(response.status_code, 429)
+        self.assertGreaterEqual(int(response.headers['Retry-After']), 1)
+
+        self._logger.info('Making sure that other users are not limited')
+        users['avivbh'].send('get', '/users/me')
+
+        self._logger.info('Exceeding the rate limit of banuni with a session token')
+        login = self._send_request_as('banuni', 'cyber')('post', '/users/login')
+        bearer = {'authorization': 'Bearer {0}'.format(login['token'])}
+
+        for _ in xrange(3):
+            self._send_request('get', '/users/me', headers=bearer)
+
+        self._send_request('get', '/users/me', headers=bearer, expected_status=429)
+
+    @server_options('--max-in-flight 1')
+    def test_max_in_flight(self):
+        '''
+        Tests that requests beyond the cap of concurrently handled requests are rejected.
+        '''
+        users = self._register_preset_users()
+
+        self._logger.info('Holding the only slot with a long polling request')
+        poller = threading.Thread(target=users['avivbh'].send, args=['get', '/messages'],
+                                  kwargs={'params': {'after_id': 0, 'wait': 2}})
+        poller.start()
+        time.sleep(0.5)
+
+        response = requests.get('http://localhost:{0}/users/me'.format(SanityTestCase.server_port),
+                                headers={'x-user-name': 'roysom', 'x-user-token': 'bananas'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+
+        self._logger.info('Making sure that requests are handled once the slot is released')
+        poller.join()
+        users['roysom'].send('get', '/users/me')
+
+    @server_options('--metrics')
+    def test_metrics(self):
+        '''
+        Tests that handled requests are counted in the metrics of the server.
+        '''
+        users = self._register_preset_users()
+        users['roysom'].send('get', '/users/me')
+        users['roysom'].send('get', '/users/friends', params={'username': 'nobody'}, expected_status=404)
+
+        # requests are recorded once their response has been sent, which may be after the client has received it
+        time.sleep(0.5)
+
+        self._logger.info('Checking the exposed metrics')
+        response = requests.get('http://localhost:{0}/metrics'.format(SanityTestCase.server_port))
+        self.assertEqual(response.status_code, 200)
+
+        samples = dict(line.rsplit(' ', 1) for line in response.text.splitlines() if not line.startswith('#'))
+        self.assertEqual(samples['http_requests_total{endpoint="/users",method="POST",status="201"}'], '3')
+        self.assertEqual(samples['http_requests_total{endpoint="/users/me",method="GET",status="200"}'], '1')
+        self.assertEqual(samples['http_requests_total{endpoint="/users/friends",method="GET",status="404"}'], '1')
+        self.assertEqual(samples['http_request_duration_seconds_count{endpoint="/users/me",method="GET",status="200"}'],
+                         '1')
+        self.assertIn('db_pool_checked_out{db="primary"}', samples)
+        self.assertIn('auth_cache_hits_total', samples)